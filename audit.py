@@ -0,0 +1,314 @@
+# gateway/audit.py
+"""
+Журнал денежных событий с отложенной пакетной записью (write-behind).
+
+Обработчики wallet и sonic после успешной операции вызывают emit(): событие
+кладётся в очередь процесса, и запрос не ждёт записи. Фоновая задача
+забирает события пачками (AUDIT_BATCH_SIZE или раз в AUDIT_FLUSH_INTERVAL —
+что наступит раньше) и пишет их через COPY в ledger_events, а переводы —
+ещё и в transfers (историю /wallet/transfers).
+
+Очередь ограничена AUDIT_QUEUE_SIZE. Что не записалось в БД или не
+успело уйти при остановке, дописывается в файл AUDIT_SPOOL_PATH (NDJSON):
+каждая пачка — один write() в файл, открытый с O_APPEND, так что строки
+нескольких воркеров не перемешиваются. Не влезшее в очередь копится
+в буфере и уходит в файл из фоновой задачи (write и fsync — в потоке):
+перегруженный шлюз не должен ещё и ждать диска в каждом запросе.
+
+При старте воркер забирает файл переименованием в AUDIT_SPOOL_PATH.<pid>
+и загружает в БД — свой и брошенные упавшими воркерами; файл, который
+сейчас загружает живой воркер, заблокирован flock'ом и пропускается.
+Повреждённые строки пропускаются с записью в лог.
+События теряются только при аварийном падении процесса или если не
+удалось записать и файл (тогда они считаются в dropped), поэтому
+transfers может отставать от балансов на время одного сброса.
+
+emit() вызывается уже после того, как деньги сдвинулись, и не бросает
+исключений: ошибка журнала не должна превращать выполненную операцию в 500.
+"""
+
+import asyncio
+import fcntl
+import glob
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import NamedTuple
+from uuid import UUID
+
+from db import get_pool
+
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "50000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "1000"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "0.5"))
+AUDIT_SPOOL_PATH = os.getenv("AUDIT_SPOOL_PATH", "audit-spool.ndjson")
+
+log = logging.getLogger(__name__)
+
+EVENT_COLUMNS = ("kind", "user_id", "counterparty", "amount", "token_id", "ref", "created_at")
+TRANSFER_COLUMNS = ("from_user", "to_user", "amount", "created_at")
+
+
+class Event(NamedTuple):
+    kind: str                  # topup | reserve | claim | release | transfer | unapplied_issuance
+    user_id: int               # чей баланс изменился первым (плательщик, владелец)
+    counterparty: int | None   # предъявитель токена, получатель перевода
+    amount: Decimal
+    token_id: UUID | None
+    ref: str | None            # job_id перевода и т. п.
+    created_at: datetime
+
+    def to_json(self) -> str:
+        return json.dumps({
+            **self._asdict(),
+            "amount": str(self.amount),
+            "token_id": str(self.token_id) if self.token_id else None,
+            "created_at": self.created_at.isoformat(),
+        })
+
+    @classmethod
+    def from_json(cls, raw: str) -> "Event":
+        d = json.loads(raw)
+        return cls(
+            d["kind"], d["user_id"], d["counterparty"], Decimal(d["amount"]),
+            UUID(d["token_id"]) if d["token_id"] else None, d["ref"],
+            datetime.fromisoformat(d["created_at"]),
+        )
+
+
+_STOP = object()
+
+
+class AuditWriter:
+    def __init__(self):
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        # не влезшее в очередь; в файл его пишет _spool_overflow
+        self._overflow: list[Event] = []
+        self._overflow_ready: asyncio.Event | None = None
+        self._spooler: asyncio.Task | None = None
+        # счётчики для /metrics
+        self.written = 0
+        self.spooled = 0
+        self.dropped = 0
+
+    def emit(
+        self,
+        kind: str,
+        user_id: int,
+        amount,
+        counterparty: int | None = None,
+        token_id: UUID | str | None = None,
+        ref: str | None = None,
+    ):
+        try:
+            event = Event(
+                kind, user_id, counterparty, Decimal(str(amount)),
+                UUID(str(token_id)) if token_id else None, ref,
+                datetime.now(timezone.utc),
+            )
+            if self._queue is None or len(self._overflow) >= AUDIT_QUEUE_SIZE:
+                # писатель не запущен или не успевает даже с файлом — не теряем
+                self._spool([event])
+            elif self._queue.qsize() >= AUDIT_QUEUE_SIZE:
+                self._overflow.append(event)
+                self._overflow_ready.set()
+            else:
+                self._queue.put_nowait(event)
+        except Exception:
+            self.dropped += 1
+            log.exception("audit: %s event for user %s dropped", kind, user_id)
+
+    @property
+    def queued(self) -> int:
+        return (self._queue.qsize() if self._queue is not None else 0) + len(self._overflow)
+
+    async def start(self):
+        await self._replay_spool()
+        # границу очереди держит emit(): стоп-сигнал должен влезать всегда
+        self._queue = asyncio.Queue()
+        self._overflow_ready = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        self._spooler = asyncio.create_task(self._spool_overflow())
+
+    async def stop(self, timeout: float):
+        """
+        Дописывает очередь в БД; что не успело за timeout — в файл.
+        """
+        if self._task is None:
+            return
+        queue, self._queue = self._queue, None
+        queue.put_nowait(_STOP)
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except Exception as e:
+            # остановку шлюза не прерываем: остаток очереди — в файл
+            if isinstance(e, asyncio.TimeoutError):
+                log.warning("audit: flush did not finish in %.1fs, spooling", timeout)
+            else:
+                log.exception("audit: writer failed, spooling the queue")
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            left = []
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not _STOP:
+                    left.append(item)
+            self._spool(left)
+        self._spooler.cancel()
+        await asyncio.gather(self._spooler, return_exceptions=True)
+        overflow, self._overflow = self._overflow, []
+        self._spool(overflow)
+        self._task = self._spooler = None
+
+    async def _spool_overflow(self):
+        while True:
+            await self._overflow_ready.wait()
+            self._overflow_ready.clear()
+            batch, self._overflow = self._overflow, []
+            await asyncio.to_thread(self._spool, batch)
+
+    async def _run(self):
+        queue = self._queue
+        while True:
+            item = await queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + AUDIT_FLUSH_INTERVAL
+            stop = False
+            while len(batch) < AUDIT_BATCH_SIZE:
+                if queue.empty():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = queue.get_nowait()
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                await self._flush(batch)
+            except asyncio.CancelledError:
+                self._spool(batch)
+                raise
+            if stop:
+                return
+
+    async def _flush(self, batch: list[Event]):
+        try:
+            await self.write(batch)
+        except Exception:
+            # таймаут пула и обрыв соединения тоже: пачка в файл, писатель живёт дальше
+            log.exception("audit: flush of %d events failed, spooling", len(batch))
+            self._spool(batch)
+
+    async def write(self, batch: list[Event]):
+        """Одна транзакция: COPY событий и COPY переводов в историю."""
+        transfers = [
+            (e.user_id, e.counterparty, e.amount, e.created_at)
+            for e in batch if e.kind == "transfer"
+        ]
+        pool = get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.copy_records_to_table(
+                    "ledger_events", records=batch, columns=EVENT_COLUMNS
+                )
+                if transfers:
+                    await conn.copy_records_to_table(
+                        "transfers", records=transfers, columns=TRANSFER_COLUMNS
+                    )
+        self.written += len(batch)
+
+    def _spool(self, events: list[Event]):
+        """Дописывает пачку в файл; не бросает — неудача считается в dropped."""
+        if not events:
+            return
+        data = "".join(e.to_json() + "\n" for e in events).encode()
+        try:
+            for _ in range(3):
+                fd = os.open(AUDIT_SPOOL_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # файл между open и flock забрали на загрузку — берём новый
+                        continue
+                    if os.fstat(fd).st_nlink == 0:
+                        continue
+                    # один write на пачку: O_APPEND не даёт пачкам воркеров перемешаться
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(fd, view):]
+                    os.fsync(fd)
+                    break
+                finally:
+                    os.close(fd)
+            else:
+                raise OSError("audit spool is being replaced")
+        except OSError:
+            self.dropped += len(events)
+            log.exception("audit: %d events lost, spool is not writable", len(events))
+            return
+        self.spooled += len(events)
+
+    async def _replay_spool(self):
+        # переименование атомарно: файл забирает ровно один воркер
+        try:
+            os.rename(AUDIT_SPOOL_PATH, f"{AUDIT_SPOOL_PATH}.{os.getpid()}")
+        except FileNotFoundError:
+            pass
+        # свой файл и брошенные: воркер упал между переименованием и загрузкой
+        for path in glob.glob(glob.escape(AUDIT_SPOOL_PATH) + ".*"):
+            if path.rsplit(".", 1)[1].isdigit():
+                await self._replay_file(path)
+
+    async def _replay_file(self, path: str):
+        try:
+            f = open(path, encoding="utf-8", errors="replace")
+        except FileNotFoundError:
+            return
+        with f:
+            # держат недолго только дописывающие пачку; дольше — файл
+            # загружает живой воркер
+            for _ in range(20):
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(0.05)
+            else:
+                return
+            if os.fstat(f.fileno()).st_nlink == 0:
+                # уже загружен и удалён другим воркером
+                return
+            events = []
+            for n, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    events.append(Event.from_json(line))
+                except (ValueError, KeyError, TypeError, ArithmeticError):
+                    # оборванная при падении строка не должна мешать старту
+                    log.warning("audit: skipping bad spool line %d: %r", n, line[:200])
+            for i in range(0, len(events), AUDIT_BATCH_SIZE):
+                try:
+                    await self.write(events[i:i + AUDIT_BATCH_SIZE])
+                except Exception:
+                    log.exception("audit: spool replay failed, keeping the rest")
+                    self._spool(events[i:])
+                    break
+            os.remove(path)
+        log.info("audit: replayed %d spooled events from %s", len(events), path)
+
+
+audit = AuditWriter()
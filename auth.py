@@ -1,7 +1,7 @@
-import os, time
+import os, time, hashlib
+from datetime import datetime
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from jose import jwt
 from init_data_py import InitData
 from init_data_py.errors import (
     SignInvalidError, SignMissingError,
@@ -9,12 +9,22 @@ from init_data_py.errors import (
     UnexpectedFormatError
 )
 from db import get_pool
+from deps import upsert_user
+from cache import TTLCache
+import jwt_service
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-JWT_SECRET = os.getenv("JWT_SECRET")
-ALGO = "HS256"
-if not BOT_TOKEN or not JWT_SECRET:
-    raise RuntimeError("BOT_TOKEN и JWT_SECRET должны быть заданы")
+if not BOT_TOKEN:
+    raise RuntimeError("BOT_TOKEN должен быть задан")
+
+INIT_DATA_LIFETIME = 24*3600
+TOKEN_LIFETIME = 7*24*3600
+
+# sha256(init_data) → выданный по нему JWT. Запись живёт ровно до истечения
+# init_data (auth_date + INIT_DATA_LIFETIME), поэтому кэш заодно служит
+# индексом повторов: одна и та же init_data принимается только в своё окно.
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "100000"))
+verified_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=INIT_DATA_LIFETIME)
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
@@ -22,9 +32,12 @@ class AuthRequest(BaseModel):
     init_data: str
 
 def verify_init_data(raw: str):
+    """
+    Проверяет подпись init_data. Возвращает (user, auth_date в unix-секундах).
+    """
     try:
         init = InitData.parse(raw)
-        init.validate(bot_token=BOT_TOKEN, lifetime=24*3600)
+        init.validate(bot_token=BOT_TOKEN, lifetime=INIT_DATA_LIFETIME)
     except (
         SignInvalidError, SignMissingError,
         AuthDateMissingError, ExpiredError,
@@ -34,35 +47,30 @@ def verify_init_data(raw: str):
     user = init.user
     if not user or not hasattr(user, "id"):
         raise HTTPException(400, "Нет информации о пользователе")
-    return user
+    auth_date = init.auth_date
+    if isinstance(auth_date, datetime):
+        auth_date = auth_date.timestamp()
+    return user, float(auth_date)
 
 @router.post("/telegram")
 async def auth_telegram(body: AuthRequest):
-    user = verify_init_data(body.init_data)
+    # повторный вход с той же init_data: без HMAC, БД и подписи JWT
+    key = hashlib.sha256(body.init_data.encode()).digest()
+    token = verified_cache.get(key)
+    if token is not None:
+        return {"access_token": token}
+
+    user, auth_date = verify_init_data(body.init_data)
     telegram_id = int(user.id)
     first = user.first_name or ""
 
     pool = get_pool()
     async with pool.acquire() as conn:
-        rec = await conn.fetchrow(
-            """
-            INSERT INTO users (telegram_id, first_name)
-            VALUES ($1, $2)
-            ON CONFLICT (telegram_id) DO UPDATE
-              SET first_name = EXCLUDED.first_name
-            RETURNING id
-            """,
-            telegram_id, first
-        )
-        uid = rec["id"]
-        await conn.execute(
-            "INSERT INTO wallets (user_id) VALUES ($1) ON CONFLICT DO NOTHING",
-            uid
-        )
+        uid = await upsert_user(conn, telegram_id, first)
 
     now = int(time.time())
-    token = jwt.encode(
-        {"sub": str(telegram_id), "first": first, "iat": now, "exp": now + 7*24*3600},
-        JWT_SECRET, algorithm=ALGO
+    token = jwt_service.encode(
+        {"sub": str(telegram_id), "uid": uid, "first": first, "iat": now, "exp": now + TOKEN_LIFETIME}
     )
+    verified_cache.set(key, token, ttl=auth_date + INIT_DATA_LIFETIME - now)
     return {"access_token": token}
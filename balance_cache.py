@@ -0,0 +1,221 @@
+# gateway/balance_cache.py
+"""
+Кэш балансов кошельков для /wallet/balance.
+
+Свои изменения пишутся в кэш сразу (ledger обновляет его из RETURNING или
+сбрасывает запись), поэтому пользователь видит собственные операции без
+задержки. Другим воркерам изменённые user_id рассылаются через
+LISTEN/NOTIFY в канал wallet_changed, и те сбрасывают свои записи.
+
+Уведомления шлёт не триггер внутри денежной транзакции — NOTIFY при
+коммите берёт одну на всю базу блокировку, и за ней выстраивались бы все
+коммиты ledger, — а сам воркер уже после коммита: изменённые user_id
+копятся BALANCE_NOTIFY_WINDOW и уходят одним pg_notify со служебного
+соединения. Изменения в обход шлюза (ручной SQL) видны через
+BALANCE_CACHE_TTL.
+
+Ответ БД может разминуться с изменением, пришедшим за время запроса, —
+и при промахе, и после своей операции. Поэтому баланс кладётся, только
+если запись не менялась с version(), взятого до запроса: иначе более
+старое состояние затёрло бы уже известное новое.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from decimal import Decimal
+
+import asyncpg
+
+from cache import TTLCache
+
+BALANCE_CACHE_SIZE = int(os.getenv("BALANCE_CACHE_SIZE", "100000"))
+# страховка на случай потерянного уведомления
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", "60"))
+BALANCE_NOTIFY_WINDOW = float(os.getenv("BALANCE_NOTIFY_WINDOW", "0.005"))
+CHANNEL = "wallet_changed"
+# payload NOTIFY ограничен 8000 байт
+NOTIFY_BATCH = 500
+RECONNECT_DELAY = 1.0
+
+log = logging.getLogger(__name__)
+
+# user_id → (available, reserved)
+balances = TTLCache(maxsize=BALANCE_CACHE_SIZE, ttl=BALANCE_CACHE_TTL)
+# user_id → номер последнего изменения записи; номера — из общего счётчика
+_versions = TTLCache(maxsize=BALANCE_CACHE_SIZE, ttl=BALANCE_CACHE_TTL)
+_clock = 0
+# номер последней полной очистки кэша
+_cleared_at = 0
+
+_listener: asyncpg.Connection | None = None
+_reconnect: asyncio.Task | None = None
+_dsn: str | None = None
+
+# изменённые user_id, ещё не разосланные другим воркерам
+_pending: set[int] = set()
+_flush_handle: asyncio.TimerHandle | None = None
+_publisher: asyncio.Task | None = None
+
+
+def get(uid: int) -> tuple[Decimal, Decimal] | None:
+    return balances.get(uid)
+
+
+def version() -> int:
+    """Номер, который передаётся в put_if_unchanged после чтения из БД."""
+    return _clock
+
+
+def _touch(uid: int):
+    global _clock
+    _clock += 1
+    _versions.set(uid, _clock)
+
+
+def put(uid: int, seen: int, available: Decimal, reserved: Decimal):
+    """
+    Новый баланс после своей операции (seen — version() до неё); другие
+    воркеры сбросят запись. Если за время операции запись менялась,
+    какой баланс новее — неизвестно, и запись только сбрасывается.
+    """
+    if _changed_since(uid, seen):
+        balances.pop(uid)
+    else:
+        balances.set(uid, (available, reserved))
+    _touch(uid)
+    _publish((uid,))
+
+
+def invalidate(*uids: int):
+    """Баланс изменился, но новое значение неизвестно."""
+    invalidate_local(*uids)
+    _publish(uids)
+
+
+def invalidate_local(*uids: int):
+    """
+    Сброс только в этом воркере: зачисления в полосы горячих кошельков
+    другим воркерам рассылает компактор после свёртки (hot_wallets.fold).
+    """
+    for uid in uids:
+        balances.pop(uid)
+        _touch(uid)
+
+
+def put_if_unchanged(uid: int, seen: int, available: Decimal, reserved: Decimal):
+    """
+    Кладёт баланс, прочитанный из БД, если с момента version() == seen
+    запись не менялась: иначе в кэш попал бы баланс старше уже известного.
+    """
+    if _changed_since(uid, seen):
+        return
+    balances.set(uid, (available, reserved))
+
+
+def _changed_since(uid: int, seen: int) -> bool:
+    return _versions.get(uid, 0) > seen or _cleared_at > seen
+
+
+def _clear():
+    global _clock, _cleared_at
+    balances.clear()
+    _clock += 1
+    _cleared_at = _clock
+
+
+def _publish(uids):
+    global _flush_handle
+    if _dsn is None or not uids:
+        return
+    _pending.update(uids)
+    if _flush_handle is None:
+        _flush_handle = asyncio.get_running_loop().call_later(BALANCE_NOTIFY_WINDOW, _flush)
+
+
+def _flush():
+    global _flush_handle, _publisher
+    _flush_handle = None
+    # уже идущая рассылка заберёт и новые user_id
+    if _pending and (_publisher is None or _publisher.done()):
+        _publisher = asyncio.get_running_loop().create_task(_send())
+
+
+async def _send():
+    while _pending and _listener is not None:
+        batch = [_pending.pop() for _ in range(min(NOTIFY_BATCH, len(_pending)))]
+        try:
+            await _listener.execute("SELECT pg_notify($1, $2)", CHANNEL, json.dumps(batch))
+        except Exception:
+            # разошлём со следующим изменением или после переподключения
+            _pending.update(batch)
+            log.exception("balance change notification failed")
+            return
+
+
+def _on_notify(conn, pid, channel, payload: str):
+    if pid == conn.get_server_pid():
+        # свои изменения уже в кэше
+        return
+    try:
+        invalidate_local(*(int(uid) for uid in json.loads(payload)))
+    except (ValueError, TypeError):
+        log.warning("bad %s payload: %r", channel, payload)
+
+
+def _on_terminate(conn):
+    # пока соединения нет, уведомления теряются: кэшу больше верить нельзя
+    global _listener, _reconnect
+    _clear()
+    _listener = None
+    if _dsn is not None and (_reconnect is None or _reconnect.done()):
+        _reconnect = asyncio.get_running_loop().create_task(_connect_forever())
+
+
+async def _connect():
+    global _listener
+    conn = await asyncpg.connect(_dsn)
+    await conn.add_listener(CHANNEL, _on_notify)
+    conn.add_termination_listener(_on_terminate)
+    _listener = conn
+    # всё, что менялось до подписки, могло пройти мимо
+    _clear()
+    _flush()
+
+
+async def _connect_forever():
+    while _dsn is not None and _listener is None:
+        try:
+            await _connect()
+        except Exception as e:
+            log.warning("balance listener reconnect failed: %r", e)
+            await asyncio.sleep(RECONNECT_DELAY)
+
+
+async def start_listener(dsn: str):
+    """
+    Открывает отдельное (не из пула) соединение под LISTEN и рассылку.
+    """
+    global _dsn
+    _dsn = dsn
+    await _connect()
+
+
+async def stop_listener():
+    global _dsn, _listener, _reconnect, _flush_handle
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+    if _publisher is not None and not _publisher.done():
+        await asyncio.gather(_publisher, return_exceptions=True)
+    # последние изменения — до закрытия соединения
+    await _send()
+    _dsn = None
+    if _reconnect is not None:
+        _reconnect.cancel()
+        _reconnect = None
+    if _listener is not None:
+        conn, _listener = _listener, None
+        conn.remove_termination_listener(_on_terminate)
+        await conn.close()
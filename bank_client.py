@@ -0,0 +1,229 @@
+# gateway/bank_client.py
+"""
+Асинхронный клиент банка-эмитента для пополнений.
+
+- одно httpx.AsyncClient на процесс: пул keep-alive соединений к банку;
+- таймауты на соединение и на ответ;
+- повторы 5xx, 429 и сетевых ошибок с экспоненциальной задержкой и
+  полным джиттером; каждый выпуск несёт request_id, поэтому повтор
+  не выпускает второй токен;
+- circuit breaker: после BANK_BREAKER_THRESHOLD сбоев подряд запросы
+  сразу получают BankUnavailable, через BANK_BREAKER_COOLDOWN один
+  пробный запрос решает, закрыть ли его;
+- склейка: выпуски, пришедшие в течение BANK_BATCH_WINDOW, уходят одним
+  POST /bank/issuance/batch (не больше BANK_BATCH_MAX в пачке).
+
+Всё ожидание банка — await на сокете, соединение из пула БД при этом
+не держится (см. wallet._topup).
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+import uuid
+from decimal import Decimal
+
+import httpx
+
+# 1 — /wallet/topup сначала получает выпуск в банке, потом зачисляет
+BANK_TOPUP = os.getenv("BANK_TOPUP", "0") == "1"
+BANK_URL = os.getenv("BANK_URL", "http://127.0.0.1:8001")
+BANK_TIMEOUT = float(os.getenv("BANK_TIMEOUT", "2"))
+BANK_CONNECT_TIMEOUT = float(os.getenv("BANK_CONNECT_TIMEOUT", "0.5"))
+BANK_MAX_CONNECTIONS = int(os.getenv("BANK_MAX_CONNECTIONS", "20"))
+BANK_RETRIES = int(os.getenv("BANK_RETRIES", "3"))
+BANK_BACKOFF_BASE = float(os.getenv("BANK_BACKOFF_BASE", "0.1"))
+BANK_BACKOFF_MAX = float(os.getenv("BANK_BACKOFF_MAX", "2"))
+BANK_BREAKER_THRESHOLD = int(os.getenv("BANK_BREAKER_THRESHOLD", "5"))
+BANK_BREAKER_COOLDOWN = float(os.getenv("BANK_BREAKER_COOLDOWN", "10"))
+BANK_BATCH_WINDOW = float(os.getenv("BANK_BATCH_WINDOW", "0.005"))
+BANK_BATCH_MAX = int(os.getenv("BANK_BATCH_MAX", "100"))
+
+log = logging.getLogger(__name__)
+
+
+class BankUnavailable(Exception):
+    """Банк не ответил (после повторов) или breaker разомкнут."""
+
+
+class BankRejected(Exception):
+    """
+    Банк отказал в выпуске (4xx кроме 429) или ответил не по протоколу —
+    повторять бессмысленно.
+    """
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int = BANK_BREAKER_THRESHOLD,
+                 cooldown: float = BANK_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            # один пробный запрос; остальные ждут его исхода
+            self._probing = True
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self._probing or self.failures >= self.threshold:
+            if self.opened_at is None:
+                log.warning("bank circuit breaker opened after %d failures", self.failures)
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+
+class BankClient:
+    def __init__(self, base_url: str = BANK_URL):
+        self.base_url = base_url
+        self.breaker = CircuitBreaker()
+        self._client: httpx.AsyncClient | None = None
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+        # счётчики для /metrics
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.batched = 0
+
+    async def start(self):
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=httpx.Timeout(BANK_TIMEOUT, connect=BANK_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=BANK_MAX_CONNECTIONS,
+                max_keepalive_connections=BANK_MAX_CONNECTIONS,
+            ),
+        )
+
+    async def stop(self):
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def issue(self, amount: Decimal) -> dict:
+        """
+        Выпуск токена на amount: {token, amount, created_at}. Вызовы,
+        пришедшие почти одновременно, уходят в банк одной пачкой.
+        """
+        if self._client is None:
+            raise BankUnavailable("bank client is not started")
+        # строкой: float теряет копейки на больших суммах
+        item = {"request_id": uuid.uuid4().hex, "amount": str(amount)}
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= BANK_BATCH_MAX:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                BANK_BATCH_WINDOW, self._flush
+            )
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: list[tuple[dict, asyncio.Future]]):
+        try:
+            if len(batch) == 1:
+                results = [await self._post("/bank/issuance", batch[0][0])]
+            else:
+                body = await self._post("/bank/issuance/batch", {"items": [i for i, _ in batch]})
+                results = body.get("items") if isinstance(body, dict) else None
+                if not isinstance(results, list) or len(results) != len(batch):
+                    raise BankRejected("malformed bank batch response")
+                self.batched += len(batch)
+            if not all(isinstance(r, dict) and "token" in r for r in results):
+                raise BankRejected("malformed bank issuance response")
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _post(self, path: str, payload: dict) -> dict:
+        for attempt in range(BANK_RETRIES + 1):
+            if not self.breaker.allow():
+                raise BankUnavailable("bank circuit breaker is open")
+            if attempt:
+                self.retries += 1
+            self.requests += 1
+            delay = None
+            try:
+                resp = await self._client.post(path, json=payload)
+            except httpx.TransportError as e:
+                self.breaker.failure()
+                error: Exception = e
+            else:
+                if resp.status_code < 400:
+                    self.breaker.success()
+                    try:
+                        return resp.json()
+                    except ValueError:
+                        raise BankRejected("bank responded with invalid JSON")
+                if resp.status_code == 429:
+                    # банк жив и просит подождать — для breaker это не сбой
+                    self.breaker.success()
+                    delay = _retry_after(resp)
+                elif resp.status_code >= 500:
+                    self.breaker.failure()
+                else:
+                    self.breaker.success()
+                    raise BankRejected(f"bank rejected issuance: {resp.status_code} {resp.text}")
+                error = BankUnavailable(f"bank responded {resp.status_code}")
+            if attempt == BANK_RETRIES:
+                break
+            if delay is None:
+                # полный джиттер: равномерно от 0 до экспоненциальной границы
+                delay = random.uniform(0, min(BANK_BACKOFF_MAX, BANK_BACKOFF_BASE * 2 ** attempt))
+            await asyncio.sleep(delay)
+        self.failures += 1
+        raise BankUnavailable(str(error)) from error
+
+
+def _retry_after(resp: httpx.Response) -> float:
+    try:
+        return min(BANK_BACKOFF_MAX, float(resp.headers.get("Retry-After", "")))
+    except ValueError:
+        return BANK_BACKOFF_BASE
+
+
+bank = BankClient()
@@ -1,28 +1,122 @@
 # gateway/bank_mock.py
+"""
+Локальная заглушка банка-эмитента с настраиваемым поведением: задержка,
+доля ошибок, зависания и лимит частоты — чтобы проверять шлюз (и
+bank_client) против медленного и нестабильного банка.
 
+Подключается роутером в шлюз (/bank/*) или запускается отдельно:
+
+    BANK_MOCK_LATENCY=0.2 BANK_MOCK_ERROR_RATE=0.05 uvicorn bank_mock:app --port 8001
+"""
+
+import asyncio
+import math
+import os
+import random
+import time
 import uuid
-from datetime import datetime
-from fastapi import APIRouter
-from pydantic import BaseModel
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from fastapi import APIRouter, FastAPI, HTTPException
+from pydantic import BaseModel, Field
+
+from cache import TTLCache
+
+# задержка ответа: BANK_MOCK_LATENCY + равномерно до BANK_MOCK_JITTER, сек
+BANK_MOCK_LATENCY = float(os.getenv("BANK_MOCK_LATENCY", "0"))
+BANK_MOCK_JITTER = float(os.getenv("BANK_MOCK_JITTER", "0"))
+# доля ответов 503 и доля запросов, которые висят BANK_MOCK_HANG сек
+BANK_MOCK_ERROR_RATE = float(os.getenv("BANK_MOCK_ERROR_RATE", "0"))
+BANK_MOCK_HANG_RATE = float(os.getenv("BANK_MOCK_HANG_RATE", "0"))
+BANK_MOCK_HANG = float(os.getenv("BANK_MOCK_HANG", "30"))
+# запросов в секунду на весь банк (ёмкость корзины — BANK_MOCK_BURST); 0 — без лимита
+BANK_MOCK_RATE_LIMIT = float(os.getenv("BANK_MOCK_RATE_LIMIT", "0"))
+BANK_MOCK_BURST = float(os.getenv("BANK_MOCK_BURST", "10"))
+BATCH_MAX = 500
 
 router = APIRouter(prefix="/bank", tags=["bank"])
 
+# token bucket банка: [токены, время последнего пополнения]; без зависимостей
+# от модулей шлюза, чтобы заглушка запускалась без БД
+_bucket = [BANK_MOCK_BURST, time.monotonic()]
+# request_id → выпущенный токен: повтор запроса не выпускает второй
+_issued = TTLCache(maxsize=100_000, ttl=3600)
+
+
 class IssuanceRequest(BaseModel):
-    amount: float
+    amount: Decimal
+    request_id: str | None = None
 
 class IssuanceResponse(BaseModel):
     token: str
-    amount: float
+    amount: Decimal
     created_at: datetime
 
+class IssuanceBatchRequest(BaseModel):
+    items: list[IssuanceRequest] = Field(..., min_length=1, max_length=BATCH_MAX)
+
+class IssuanceBatchResponse(BaseModel):
+    items: list[IssuanceResponse]
+
+
+async def _behave():
+    """Лимит, задержка и сбои — как у настоящего банка под нагрузкой."""
+    if BANK_MOCK_RATE_LIMIT > 0:
+        now = time.monotonic()
+        tokens = min(BANK_MOCK_BURST, _bucket[0] + (now - _bucket[1]) * BANK_MOCK_RATE_LIMIT)
+        _bucket[1] = now
+        if tokens < 1:
+            _bucket[0] = tokens
+            retry_after = math.ceil((1 - tokens) / BANK_MOCK_RATE_LIMIT)
+            raise HTTPException(429, "Rate limit exceeded",
+                                headers={"Retry-After": str(retry_after)})
+        _bucket[0] = tokens - 1
+    delay = BANK_MOCK_LATENCY + random.uniform(0, BANK_MOCK_JITTER)
+    if BANK_MOCK_HANG_RATE and random.random() < BANK_MOCK_HANG_RATE:
+        delay = BANK_MOCK_HANG
+    if delay:
+        await asyncio.sleep(delay)
+    if BANK_MOCK_ERROR_RATE and random.random() < BANK_MOCK_ERROR_RATE:
+        raise HTTPException(503, "Bank temporarily unavailable")
+
+
+def _issue(req: IssuanceRequest) -> IssuanceResponse:
+    if req.amount <= 0:
+        raise HTTPException(400, "Сумма должна быть > 0")
+    if req.request_id is not None:
+        issued = _issued.get(req.request_id)
+        if issued is not None:
+            return issued
+    issued = IssuanceResponse(
+        token=str(uuid.uuid4()),
+        amount=req.amount,
+        created_at=datetime.now(timezone.utc),
+    )
+    if req.request_id is not None:
+        _issued.set(req.request_id, issued)
+    return issued
+
+
 @router.post("/issuance", response_model=IssuanceResponse)
 async def issuance(req: IssuanceRequest):
     """
     Mock-банк: генерирует токен-UUID для указанной суммы.
+    Повтор с тем же request_id возвращает тот же токен.
     """
-    fake_token = str(uuid.uuid4())
-    return IssuanceResponse(
-        token=fake_token,
-        amount=req.amount,
-        created_at=datetime.utcnow(),
-    )
+    await _behave()
+    return _issue(req)
+
+
+@router.post("/issuance/batch", response_model=IssuanceBatchResponse)
+async def issuance_batch(req: IssuanceBatchRequest):
+    """
+    Пачка выпусков за один запрос (одна задержка и одна единица лимита).
+    """
+    await _behave()
+    return IssuanceBatchResponse(items=[_issue(item) for item in req.items])
+
+
+# отдельный процесс: uvicorn bank_mock:app
+app = FastAPI(title="Bank mock")
+app.include_router(router)
@@ -0,0 +1,60 @@
+# gateway/bench/auth_cache.py
+"""
+Пропускная способность /auth/telegram: холодный кэш (каждый раз новая
+init_data — HMAC, upsert, подпись JWT) против тёплого (повторный вход
+с той же init_data).
+
+    python -m bench.auth_cache --requests 5000 --concurrency 20
+"""
+
+import argparse
+import asyncio
+import time
+
+from bench.common import Timer, make_init_data, print_row, summarize
+
+import auth
+from db import init_db, close_db
+
+TG_BASE = 9_200_000_000
+
+
+async def drive(name: str, bodies: list, concurrency: int) -> dict:
+    samples: list[float] = []
+    queue = list(bodies)
+
+    async def worker():
+        while queue:
+            body = queue.pop()
+            t0 = time.perf_counter()
+            await auth.auth_telegram(body)
+            samples.append(time.perf_counter() - t0)
+
+    with Timer() as t:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(name, samples, t.elapsed)
+
+
+async def main(args):
+    await init_db(None)
+    try:
+        cold = [
+            auth.AuthRequest(init_data=make_init_data(TG_BASE + i % args.users))
+            for i in range(args.requests)
+        ]
+        auth.verified_cache.clear()
+        print_row(await drive("cold (verify + upsert + sign)", cold, args.concurrency))
+
+        warm = [cold[i % args.users] for i in range(args.requests)]
+        print_row(await drive("warm (cached token)", warm, args.concurrency))
+        print("  cache:", auth.verified_cache.stats())
+    finally:
+        await close_db()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--requests", type=int, default=5000)
+    p.add_argument("--concurrency", type=int, default=20)
+    p.add_argument("--users", type=int, default=500)
+    asyncio.run(main(p.parse_args()))
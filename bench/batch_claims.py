@@ -0,0 +1,54 @@
+# gateway/bench/batch_claims.py
+"""
+N последовательных ledger.claim (по соединению из пула на каждый, как
+в /wallet/claim) против одного ledger.claim_batch.
+
+    python -m bench.batch_claims --tokens 1000
+"""
+
+import argparse
+import asyncio
+from decimal import Decimal
+
+from bench.common import Timer
+from bench.ledger_stress import setup_wallets
+
+import ledger
+from db import init_db, close_db, get_pool
+
+
+async def reserve(pool, uid: int, n: int) -> list:
+    async with pool.acquire() as conn:
+        issued = await ledger.reserve_batch(conn, uid, [Decimal("1.00")] * n)
+    return [r["token_id"] for r in issued.values()]
+
+
+async def main(args):
+    await init_db(None)
+    pool = get_pool()
+    try:
+        owner, claimer = await setup_wallets(pool, 2, Decimal(args.tokens * 2))
+
+        tokens = await reserve(pool, owner, args.tokens)
+        with Timer() as seq:
+            for token_id in tokens:
+                async with pool.acquire() as conn:
+                    await ledger.claim(conn, token_id, claimer)
+
+        tokens = await reserve(pool, owner, args.tokens)
+        with Timer() as batch:
+            async with pool.acquire() as conn:
+                claimed = await ledger.claim_batch(conn, tokens, claimer)
+        assert len(claimed) == args.tokens
+
+        print(f"{args.tokens} sequential claims: {seq.elapsed * 1000:.1f} ms")
+        print(f"1 batch of {args.tokens} claims: {batch.elapsed * 1000:.1f} ms"
+              f" ({seq.elapsed / batch.elapsed:.1f}x)")
+    finally:
+        await close_db()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--tokens", type=int, default=1000)
+    asyncio.run(main(p.parse_args()))
@@ -0,0 +1,83 @@
+# gateway/bench/common.py
+"""
+Общие помощники для бенчмарков: окружение, импорт модулей шлюза, статистика.
+
+Бенчмарки запускаются из корня репозитория против локального Postgres:
+
+    DATABASE_URL=postgresql://postgres@localhost/gateway_bench \\
+        python -m bench.<имя>
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import statistics
+import sys
+import time
+from urllib.parse import urlencode
+
+# модули шлюза лежат в корне репозитория и читают окружение при импорте
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+os.environ.setdefault("DATABASE_URL", "postgresql://postgres@localhost/gateway_bench")
+os.environ.setdefault("JWT_SECRET", "bench-jwt-secret")
+os.environ.setdefault("BOT_TOKEN", "123456:bench-bot-token")
+os.environ.setdefault("DB_AUTO_MIGRATE", "1")
+
+
+def percentile(samples: list[float], p: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    k = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[k]
+
+
+def summarize(name: str, samples: list[float], elapsed: float) -> dict:
+    """
+    samples — задержки отдельных операций в секундах, elapsed — общее время.
+    """
+    return {
+        "name": name,
+        "count": len(samples),
+        "rps": len(samples) / elapsed if elapsed else 0.0,
+        "mean_ms": statistics.fmean(samples) * 1000 if samples else 0.0,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p95_ms": percentile(samples, 95) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+    }
+
+
+def print_row(row: dict):
+    print(
+        f"{row['name']:<32} {row['count']:>8} ops "
+        f"{row['rps']:>10.0f} ops/s "
+        f"p50={row['p50_ms']:.3f}ms p95={row['p95_ms']:.3f}ms p99={row['p99_ms']:.3f}ms"
+    )
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def make_init_data(telegram_id: int, first_name: str = "bench", auth_date: int | None = None) -> str:
+    """
+    Валидная Telegram WebApp init_data, подписанная тестовым BOT_TOKEN.
+    """
+    fields = {
+        "auth_date": str(auth_date or int(time.time())),
+        "query_id": f"bench-{telegram_id}-{time.time_ns()}",
+        "user": json.dumps({"id": telegram_id, "first_name": first_name}, separators=(",", ":")),
+    }
+    check_string = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    secret = hmac.digest(b"WebAppData", os.environ["BOT_TOKEN"].encode(), hashlib.sha256)
+    fields["hash"] = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
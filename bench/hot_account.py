@@ -0,0 +1,65 @@
+# gateway/bench/hot_account.py
+"""
+Зачисления в один кошелёк (мерчант) от многих отправителей одновременно:
+обычный режим (UPDATE одной строки wallets) против горячего (полосы
+wallet_stripes + компактор). В конце проверяется сохранность денег.
+
+    python -m bench.hot_account --clients 64 --ops 200
+"""
+
+import argparse
+import asyncio
+import time
+from decimal import Decimal
+
+from bench.common import Timer, print_row, summarize
+from bench.ledger_stress import setup_wallets, total
+
+import hot_wallets
+import ledger
+from db import init_db, close_db, get_pool
+
+
+async def drive(name: str, pool, senders: list[int], merchant: int, ops: int) -> dict:
+    samples: list[float] = []
+
+    async def client(sender: int):
+        for _ in range(ops):
+            t0 = time.perf_counter()
+            async with pool.acquire() as conn:
+                await ledger.transfer(conn, sender, merchant, Decimal("0.42"))
+            samples.append(time.perf_counter() - t0)
+
+    with Timer() as t:
+        await asyncio.gather(*(client(s) for s in senders))
+    return summarize(name, samples, t.elapsed)
+
+
+async def main(args):
+    await init_db(None)
+    pool = get_pool()
+    try:
+        uids = await setup_wallets(pool, args.clients + 1, Decimal("100000.00"))
+        merchant, senders = uids[0], uids[1:]
+        before = await total(pool, uids)
+
+        # автоопределение не должно вмешаться в замер обычного режима
+        hot_wallets.HOT_CREDITS_PER_SEC = 10**9
+        print_row(await drive("plain wallet row", pool, senders, merchant, args.ops))
+
+        hot_wallets._hot.add(merchant)
+        print_row(await drive("hot wallet stripes", pool, senders, merchant, args.ops))
+        async with pool.acquire() as conn:
+            await hot_wallets.fold(conn)
+
+        after = await total(pool, uids)
+        print(f"balance before={before} after={after} conserved={before == after}")
+    finally:
+        await close_db()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--clients", type=int, default=64)
+    p.add_argument("--ops", type=int, default=200)
+    asyncio.run(main(p.parse_args()))
@@ -0,0 +1,71 @@
+# gateway/bench/identity_cache.py
+"""
+Пропускная способность deps.current_user: upsert на каждый запрос
+против кэша идентичностей и подписанного uid в токене.
+
+    python -m bench.identity_cache --requests 20000 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import time
+
+from bench.common import Timer, print_row, summarize
+
+from fastapi.security import HTTPAuthorizationCredentials
+
+import deps
+import jwt_service
+from db import init_db, close_db
+
+
+def make_token(telegram_id: int, uid: int | None = None) -> HTTPAuthorizationCredentials:
+    now = int(time.time())
+    claims = {"sub": str(telegram_id), "first": "bench", "iat": now, "exp": now + 3600}
+    if uid is not None:
+        claims["uid"] = uid
+    token = jwt_service.encode(claims)
+    return HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+
+
+async def drive(name: str, creds: list, requests: int, concurrency: int) -> dict:
+    samples: list[float] = []
+    per_worker = requests // concurrency
+
+    async def worker(i: int):
+        for n in range(per_worker):
+            t0 = time.perf_counter()
+            await deps.current_user(creds[(i + n) % len(creds)])
+            samples.append(time.perf_counter() - t0)
+
+    with Timer() as t:
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    return summarize(name, samples, t.elapsed)
+
+
+async def main(args):
+    await init_db(None)
+    try:
+        users = range(9_000_000_000, 9_000_000_000 + args.users)
+        plain = [make_token(tg) for tg in users]
+
+        deps.identity_cache.maxsize = 0
+        print_row(await drive("upsert per request", plain, args.requests, args.concurrency))
+
+        deps.identity_cache.maxsize = deps.IDENTITY_CACHE_SIZE
+        deps.identity_cache.clear()
+        print_row(await drive("identity cache", plain, args.requests, args.concurrency))
+        print("  cache:", deps.identity_cache.stats())
+
+        signed = [make_token(tg, deps.identity_cache.get(tg)) for tg in users]
+        print_row(await drive("signed uid claim", signed, args.requests, args.concurrency))
+    finally:
+        await close_db()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--requests", type=int, default=20000)
+    p.add_argument("--concurrency", type=int, default=50)
+    p.add_argument("--users", type=int, default=1000)
+    asyncio.run(main(p.parse_args()))
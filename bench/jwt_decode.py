@@ -0,0 +1,53 @@
+# gateway/bench/jwt_decode.py
+"""
+Проверок JWT в секунду на одно ядро: python-jose (если установлен),
+jwt_service без кэша и с тёплым кэшем. Postgres не нужен.
+
+    python -m bench.jwt_decode --tokens 1000 --rounds 50
+"""
+
+import argparse
+import time
+
+from bench.common import Timer
+
+import jwt_service
+
+
+def run(name: str, decode, tokens: list[str], rounds: int):
+    with Timer() as t:
+        for _ in range(rounds):
+            for token in tokens:
+                decode(token)
+    total = len(tokens) * rounds
+    print(f"{name:<28} {total / t.elapsed:>12.0f} decodes/s/core")
+
+
+def main(args):
+    now = int(time.time())
+    tokens = [
+        jwt_service.encode({"sub": str(i), "uid": i, "first": "bench", "iat": now, "exp": now + 3600})
+        for i in range(args.tokens)
+    ]
+
+    try:
+        from jose import jwt
+    except ImportError:
+        print("python-jose не установлен — пропускаем")
+    else:
+        run("python-jose", lambda t: jwt.decode(t, jwt_service.JWT_SECRET, algorithms=["HS256"]),
+            tokens, args.rounds)
+
+    cache = jwt_service.decode_cache
+    cache.maxsize = 0
+    run("jwt_service (no cache)", jwt_service.decode, tokens, args.rounds)
+    cache.maxsize = jwt_service.DECODE_CACHE_SIZE
+    run("jwt_service (warm cache)", jwt_service.decode, tokens, args.rounds)
+    print("  cache:", cache.stats())
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--tokens", type=int, default=1000)
+    p.add_argument("--rounds", type=int, default=50)
+    main(p.parse_args())
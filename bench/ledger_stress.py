@@ -0,0 +1,108 @@
+# gateway/bench/ledger_stress.py
+"""
+Стресс-тест ledger: N параллельных клиентов делают reserve / claim / transfer
+над общим набором кошельков, затем проверяется, что деньги сохранились:
+сумма available + reserved по тестовым кошелькам не изменилась.
+
+    python -m bench.ledger_stress --clients 64 --ops 200
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from collections import defaultdict
+from decimal import Decimal
+from uuid import uuid4
+
+import asyncpg
+
+from bench.common import Timer, print_row, summarize
+
+import ledger
+from db import init_db, close_db, get_pool
+
+TG_BASE = 9_100_000_000
+
+
+async def setup_wallets(pool, users: int, balance: Decimal) -> list[int]:
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            INSERT INTO users (telegram_id, first_name)
+            SELECT g, 'stress' FROM generate_series($1::bigint, $2::bigint) g
+            ON CONFLICT (telegram_id) DO UPDATE SET first_name = EXCLUDED.first_name
+            RETURNING id
+            """,
+            TG_BASE, TG_BASE + users - 1
+        )
+        uids = [r["id"] for r in rows]
+        await conn.execute(
+            """
+            INSERT INTO wallets (user_id, available, reserved)
+            SELECT unnest($1::int[]), $2, 0
+            ON CONFLICT (user_id) DO UPDATE SET available = EXCLUDED.available, reserved = 0
+            """,
+            uids, balance
+        )
+    return uids
+
+
+async def total(pool, uids: list[int]) -> Decimal:
+    async with pool.acquire() as conn:
+        return await conn.fetchval(
+            "SELECT sum(available + reserved) FROM wallets WHERE user_id = ANY($1::int[])",
+            uids
+        )
+
+
+async def main(args):
+    await init_db(None)
+    pool = get_pool()
+    try:
+        uids = await setup_wallets(pool, args.users, Decimal("1000.00"))
+        before = await total(pool, uids)
+        tokens: list[str] = []
+        samples: dict[str, list[float]] = defaultdict(list)
+        errors: dict[str, int] = defaultdict(int)
+
+        async def client():
+            for _ in range(args.ops):
+                op = random.choice(("reserve", "claim", "transfer"))
+                a, b = random.sample(uids, 2)
+                t0 = time.perf_counter()
+                try:
+                    async with pool.acquire() as conn:
+                        if op == "reserve":
+                            token_id = str(uuid4())
+                            if await ledger.reserve(conn, a, token_id, Decimal("1.50")):
+                                tokens.append(token_id)
+                        elif op == "claim" and tokens:
+                            await ledger.claim(conn, tokens.pop(), b)
+                        else:
+                            await ledger.transfer(conn, a, b, Decimal("0.42"))
+                except asyncpg.DeadlockDetectedError:
+                    errors[op] += 1
+                samples[op].append(time.perf_counter() - t0)
+
+        with Timer() as t:
+            await asyncio.gather(*(client() for _ in range(args.clients)))
+
+        for op, lat in sorted(samples.items()):
+            print_row(summarize(op, lat, t.elapsed))
+        after = await total(pool, uids)
+        # ledger блокирует кошельки по возрастанию user_id — взаимоблокировок быть не должно
+        print(f"deadlocks: {dict(errors)}")
+        print(f"balance before={before} after={after} conserved={before == after}")
+        if before != after or errors:
+            raise SystemExit(1)
+    finally:
+        await close_db()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--clients", type=int, default=64)
+    p.add_argument("--ops", type=int, default=200)
+    p.add_argument("--users", type=int, default=100)
+    asyncio.run(main(p.parse_args()))
@@ -0,0 +1,273 @@
+# gateway/bench/loadtest.py
+"""
+Нагрузочный прогон шлюза по HTTP со смешанным профилем трафика.
+
+Поднимает uvicorn с main:app (или бьёт в уже запущенный --base-url),
+авторизует виртуальных пользователей через /auth/telegram с init_data,
+подписанной тестовым BOT_TOKEN, и гоняет смесь: опрос баланса,
+topup / reserve / claim, списки токенов, sonic-переводы, повторный вход.
+Итог — throughput и p50/p95/p99 по каждому эндпоинту в JSON; с --baseline
+сравнивает с прошлым прогоном и завершается с кодом 1 при регрессии.
+
+    pip install -r bench/requirements.txt
+    python -m bench.loadtest --users 50 --duration 30 --out results.json
+    python -m bench.loadtest --baseline results.json --tolerance 0.15
+
+Postgres: DATABASE_URL (по умолчанию локальный gateway_bench) или --temp-pg —
+временный кластер через initdb/pg_ctl из PATH, без контейнеров.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+
+import httpx
+
+from bench.common import ROOT, make_init_data, percentile
+
+TG_BASE = 9_300_000_000
+
+# вес сценария ~ доля в реальном трафике мини-приложения
+MIX = {
+    "balance": 50,
+    "tokens": 8,
+    "topup": 8,
+    "reserve": 12,
+    "claim": 10,
+    "transfer": 4,
+    "auth": 8,
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def temp_postgres():
+    """
+    Одноразовый кластер Postgres в tmp-каталоге (нужны initdb и pg_ctl в PATH).
+    """
+    if not shutil.which("initdb") or not shutil.which("pg_ctl"):
+        raise SystemExit("--temp-pg: initdb/pg_ctl не найдены в PATH")
+    data = tempfile.mkdtemp(prefix="gateway-pg-")
+    port = free_port()
+    subprocess.run(["initdb", "-A", "trust", "-U", "postgres", "-D", data],
+                   check=True, stdout=subprocess.DEVNULL)
+    subprocess.run(
+        ["pg_ctl", "-D", data, "-w", "-l", os.path.join(data, "log"), "start",
+         "-o", f"-p {port} -k {data} -c listen_addresses='' -c max_connections=200"],
+        check=True, stdout=subprocess.DEVNULL,
+    )
+    try:
+        yield f"postgresql://postgres@/postgres?host={data}&port={port}"
+    finally:
+        subprocess.run(["pg_ctl", "-D", data, "-m", "fast", "stop"], stdout=subprocess.DEVNULL)
+        shutil.rmtree(data, ignore_errors=True)
+
+
+@contextmanager
+def run_gateway(dsn: str, workers: int):
+    port = free_port()
+    # все виртуальные пользователи идут с 127.0.0.1 и упирались бы в лимиты,
+    # а прогон меряет шлюз, а не долю 429
+    env = dict(os.environ, DATABASE_URL=dsn, DB_AUTO_MIGRATE="1", RATE_LIMIT_BACKEND="off")
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=ROOT, env=env,
+    )
+    base = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                if httpx.get(f"{base}/health/ready").status_code == 200:
+                    break
+            except httpx.TransportError:
+                pass
+            if proc.poll() is not None or time.monotonic() > deadline:
+                raise SystemExit("шлюз не стал ready за 30 с")
+            time.sleep(0.2)
+        yield base
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+class Stats:
+    def __init__(self):
+        self.latency: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+
+    def record(self, name: str, elapsed: float, ok: bool):
+        self.latency[name].append(elapsed)
+        if not ok:
+            self.errors[name] += 1
+
+    def report(self, duration: float) -> dict:
+        return {
+            name: {
+                "count": len(samples),
+                "errors": self.errors[name],
+                "rps": len(samples) / duration,
+                "p50_ms": percentile(samples, 50) * 1000,
+                "p95_ms": percentile(samples, 95) * 1000,
+                "p99_ms": percentile(samples, 99) * 1000,
+            }
+            for name, samples in sorted(self.latency.items())
+        }
+
+
+class VirtualUser:
+    def __init__(self, client: httpx.AsyncClient, stats: Stats, telegram_id: int, peers: list):
+        self.client = client
+        self.stats = stats
+        self.telegram_id = telegram_id
+        self.peers = peers
+        self.headers: dict = {}
+        self.uid: int | None = None
+
+    async def call(self, name: str, method: str, url: str,
+                   expected: tuple[int, ...] = (200,), **kwargs) -> httpx.Response | None:
+        """
+        expected — статусы, которые считаются успехом: 2xx сценария и его
+        бизнес-отказы; остальное (401, 429, 5xx, ...) — ошибка.
+        """
+        t0 = time.perf_counter()
+        try:
+            resp = await self.client.request(method, url, headers=self.headers, **kwargs)
+        except httpx.TransportError:
+            self.stats.record(name, time.perf_counter() - t0, False)
+            return None
+        self.stats.record(name, time.perf_counter() - t0, resp.status_code in expected)
+        return resp
+
+    async def auth(self):
+        resp = await self.call("auth", "POST", "/auth/telegram",
+                               json={"init_data": make_init_data(self.telegram_id)})
+        if resp is not None and resp.status_code == 200:
+            token = resp.json()["access_token"]
+            self.headers = {"Authorization": f"Bearer {token}"}
+            payload = token.split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+            self.uid = claims["uid"]
+
+    async def step(self, scenario: str):
+        if scenario == "auth":
+            await self.auth()
+        elif scenario == "balance":
+            await self.call("balance", "GET", "/wallet/balance")
+        elif scenario == "tokens":
+            await self.call("tokens", "GET", "/wallet/tokens", params={"limit": 50})
+        elif scenario == "topup":
+            await self.call("topup", "POST", "/wallet/topup", json={"amount": 100})
+        elif scenario == "reserve":
+            # 400 — не хватает средств
+            resp = await self.call("reserve", "POST", "/wallet/reserve",
+                                   expected=(200, 400), json={"amount": 1.5})
+            if resp is not None and resp.status_code == 200:
+                self.peers.append(resp.json()["token_id"])
+        elif scenario == "claim" and self.peers:
+            token_id = self.peers.pop(random.randrange(len(self.peers)))
+            # 404 — токен уже погашен или просрочен
+            await self.call("claim", "POST", "/wallet/claim",
+                            expected=(200, 404), json={"token_id": token_id})
+        elif scenario == "transfer" and self.uid is not None:
+            await self.call("transfer", "POST", "/sonic/transfer",
+                            expected=(202,), json={"to_user_id": self.uid + 1})
+
+
+async def drive(base: str, users: int, duration: float, concurrency: int) -> tuple[Stats, float]:
+    stats = Stats()
+    tokens: list = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=30) as client:
+        vusers = [VirtualUser(client, stats, TG_BASE + i, tokens) for i in range(users)]
+        await asyncio.gather(*(u.auth() for u in vusers))
+        await asyncio.gather(*(u.call("topup", "POST", "/wallet/topup", json={"amount": 1000})
+                               for u in vusers))
+        names, weights = zip(*MIX.items())
+        stop = time.monotonic() + duration
+
+        async def loop(user: VirtualUser):
+            while time.monotonic() < stop:
+                await user.step(random.choices(names, weights)[0])
+
+        started = time.perf_counter()
+        await asyncio.gather(*(loop(u) for u in vusers))
+        return stats, time.perf_counter() - started
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Регрессия: p95 вырос или rps упал больше, чем на tolerance.
+    """
+    problems = []
+    for name, base in baseline["endpoints"].items():
+        cur = results["endpoints"].get(name)
+        if cur is None:
+            continue
+        if cur["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            problems.append(f"{name}: p95 {base['p95_ms']:.1f} → {cur['p95_ms']:.1f} ms")
+        if cur["rps"] < base["rps"] * (1 - tolerance):
+            problems.append(f"{name}: rps {base['rps']:.0f} → {cur['rps']:.0f}")
+    return problems
+
+
+def main(args):
+    with ExitStack() as stack:
+        if args.base_url:
+            base = args.base_url
+        else:
+            dsn = stack.enter_context(temp_postgres()) if args.temp_pg else os.environ["DATABASE_URL"]
+            base = stack.enter_context(run_gateway(dsn, args.workers))
+        stats, elapsed = asyncio.run(drive(base, args.users, args.duration, args.concurrency))
+
+    results = {
+        "meta": {
+            "users": args.users, "duration_s": elapsed, "workers": args.workers,
+            "mix": MIX, "timestamp": time.time(),
+        },
+        "endpoints": stats.report(elapsed),
+    }
+    for name, row in results["endpoints"].items():
+        print(f"{name:<10} {row['count']:>8} req {row['rps']:>8.0f} rps err={row['errors']:<5}"
+              f" p50={row['p50_ms']:.1f} p95={row['p95_ms']:.1f} p99={row['p99_ms']:.1f} ms")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(results, json.load(f), args.tolerance)
+        for line in problems:
+            print("REGRESSION", line)
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--base-url", help="не запускать шлюз, а бить в уже работающий")
+    p.add_argument("--temp-pg", action="store_true", help="временный Postgres через initdb")
+    p.add_argument("--workers", type=int, default=1)
+    p.add_argument("--users", type=int, default=50)
+    p.add_argument("--concurrency", type=int, default=100, help="HTTP-соединений клиента")
+    p.add_argument("--duration", type=float, default=30)
+    p.add_argument("--out", help="куда записать JSON с результатами")
+    p.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    p.add_argument("--tolerance", type=float, default=0.1)
+    main(p.parse_args())
@@ -0,0 +1,101 @@
+# gateway/bench/serialization.py
+"""
+CPU на сериализацию ответа горячих маршрутов /wallet: прежний путь
+(pydantic-модели + response_model + JSONResponse) против
+serialization.RecordEncoder + FastJSONResponse (orjson).
+
+БД не нужна: строки — словари с теми же типами, что отдаёт asyncpg
+(Decimal, UUID, datetime).
+
+    python -m bench.serialization --rows 100 --requests 2000
+"""
+
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from uuid import uuid4
+
+import bench.common  # noqa: F401  — окружение и sys.path
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+
+from serialization import FastJSONResponse
+from wallet import BalanceOut, TokenOut, _balance_json, _token_json
+
+
+def make_rows(n: int) -> list[dict]:
+    now = datetime.now(timezone.utc)
+    return [
+        {
+            "token_id": uuid4(),
+            "amount": Decimal(f"{i % 5000}.{i % 100:02d}"),
+            "created_at": now - timedelta(seconds=i),
+            "redeemed_at": now if i % 3 == 0 else None,
+        }
+        for i in range(n)
+    ]
+
+
+# прежние обработчики: модель на строку, затем response_model
+def _token_out(r) -> TokenOut:
+    return TokenOut(
+        token_id=str(r["token_id"]),
+        amount=float(r["amount"]),
+        created_at=r["created_at"],
+        redeemed_at=r["redeemed_at"],
+    )
+
+
+async def before_tokens(field, rows) -> bytes:
+    content = await serialize_response(field=field, response_content=[_token_out(r) for r in rows])
+    return JSONResponse(content).body
+
+
+async def after_tokens(field, rows) -> bytes:
+    return FastJSONResponse(_token_json.many(rows)).body
+
+
+async def before_balance(field, rec) -> bytes:
+    out = BalanceOut(available=float(rec["available"]), reserved=float(rec["reserved"]))
+    return JSONResponse(await serialize_response(field=field, response_content=out)).body
+
+
+async def after_balance(field, rec) -> bytes:
+    return FastJSONResponse(_balance_json.one(rec)).body
+
+
+async def measure(name: str, fn, field, arg, requests: int) -> float:
+    await fn(field, arg)  # прогрев
+    started = time.process_time()
+    for _ in range(requests):
+        await fn(field, arg)
+    per_request = (time.process_time() - started) / requests
+    print(f"{name:<28} {per_request * 1e6:10.1f} µs CPU/request")
+    return per_request
+
+
+async def main(args):
+    rows = make_rows(args.rows)
+    tokens_field = create_model_field(name="Response", type_=list[TokenOut], mode="serialization")
+    balance_field = create_model_field(name="Response", type_=BalanceOut, mode="serialization")
+    balance = {"available": Decimal("1234.50"), "reserved": Decimal("10.00")}
+
+    print(f"GET /wallet/tokens, {args.rows} rows")
+    old = await measure("  pydantic + response_model", before_tokens, tokens_field, rows, args.requests)
+    new = await measure("  RecordEncoder + orjson", after_tokens, tokens_field, rows, args.requests)
+    print(f"  speedup x{old / new:.1f}")
+    print("GET /wallet/balance")
+    old = await measure("  pydantic + response_model", before_balance, balance_field, balance, args.requests * 10)
+    new = await measure("  RecordEncoder + orjson", after_balance, balance_field, balance, args.requests * 10)
+    print(f"  speedup x{old / new:.1f}")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--rows", type=int, default=100)
+    p.add_argument("--requests", type=int, default=2000)
+    asyncio.run(main(p.parse_args()))
@@ -1,61 +1,181 @@
+import asyncio
+import json
 import os
+import time
 import asyncpg
+import orjson
 from fastapi import FastAPI
 
+from metrics import Histogram
+from migrations import LATEST_VERSION, current_version, migrate
+
 # Берём строку подключения из переменной окружения Railway
 DB_URL = os.getenv("DATABASE_URL")
 if not DB_URL:
     raise RuntimeError("DATABASE_URL не задана в окружении")
 
-_pool: asyncpg.Pool | None = None
+def _env_float(name: str, default: str | None = None) -> float | None:
+    value = os.getenv(name, default)
+    return float(value) if value not in (None, "") else None
+
+# Параметры пула. Итоговое число соединений к Postgres = DB_POOL_MAX × воркеры × реплики,
+# его нужно держать ниже max_connections сервера.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "10"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_COMMAND_TIMEOUT = _env_float("DB_COMMAND_TIMEOUT")
+DB_ACQUIRE_TIMEOUT = _env_float("DB_ACQUIRE_TIMEOUT")
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", "300"))
+# 0 — для pgbouncer в режиме transaction pooling
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+# накатывать миграции прямо на старте (удобно локально; в проде — отдельной командой)
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "0") == "1"
+
+_pool: "InstrumentedPool | None" = None
+
+
+class PoolMetrics:
+    """
+    Метрики пула: ожидание свободного соединения и время запросов
+    по тексту оператора (через query logger asyncpg).
+    """
+
+    def __init__(self):
+        self.acquire_wait = Histogram()
+        self.queries: dict[str, Histogram] = {}
+        self.query_errors = 0
+
+    def record_query(self, record):
+        key = statement_key(record.query)
+        hist = self.queries.get(key)
+        if hist is None:
+            hist = self.queries[key] = Histogram()
+        hist.observe(record.elapsed)
+        if record.exception is not None:
+            self.query_errors += 1
+
+
+def statement_key(query: str) -> str:
+    # одинаковые операторы с разным форматированием считаем одним
+    return " ".join(query.split())[:200]
+
+
+pool_metrics = PoolMetrics()
+
+
+class _TimedAcquire:
+    def __init__(self, pool: asyncpg.Pool, timeout: float | None):
+        self._pool = pool
+        self._timeout = timeout
+        self._conn = None
+
+    async def __aenter__(self) -> asyncpg.Connection:
+        started = time.perf_counter()
+        self._conn = await self._pool.acquire(timeout=self._timeout)
+        pool_metrics.acquire_wait.observe(time.perf_counter() - started)
+        return self._conn
+
+    async def __aexit__(self, *exc):
+        conn, self._conn = self._conn, None
+        await self._pool.release(conn)
+
+
+class InstrumentedPool:
+    """
+    Обёртка над asyncpg.Pool: acquire() замеряет ожидание соединения,
+    остальное делегируется пулу как есть.
+    """
+
+    def __init__(self, pool: asyncpg.Pool):
+        self._pool = pool
+
+    def acquire(self, *, timeout: float | None = DB_ACQUIRE_TIMEOUT) -> _TimedAcquire:
+        return _TimedAcquire(self._pool, timeout)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+def _json_dumps(value) -> str:
+    # orjson: суммы в результатах sonic — orjson.Fragment (serialization.money_value)
+    return orjson.dumps(value).decode()
+
+
+def _json_loads(raw: str):
+    # дробные числа остаются JSON-текстом: 12.30 вернётся в ответ как 12.30, а не 12.3
+    return json.loads(raw, parse_float=orjson.Fragment)
+
+
+async def _init_connection(conn: asyncpg.Connection):
+    """
+    Вызывается asyncpg для каждого нового соединения пула.
+    """
+    for typename in ("json", "jsonb"):
+        await conn.set_type_codec(
+            typename, schema="pg_catalog",
+            encoder=_json_dumps, decoder=_json_loads,
+        )
+    conn.add_query_logger(pool_metrics.record_query)
+
 
 async def init_db(app: FastAPI):
     """
-    Функция-инициализатор, которую нужно зарегить в FastAPI как:
-    
-      app = FastAPI()
-      @app.on_event("startup")
-      async def startup():
+    Функция-инициализатор, вызывается из lifespan приложения (см. main.py):
+
+      @asynccontextmanager
+      async def lifespan(app):
           await init_db(app)
-      @app.on_event("shutdown")
-      async def shutdown():
+          yield
           await close_db()
     """
     global _pool
-    _pool = await asyncpg.create_pool(dsn=DB_URL)
+    _pool = InstrumentedPool(await asyncpg.create_pool(
+        dsn=DB_URL,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        init=_init_connection,
+    ))
 
-    # создаём таблицы, если они ещё не созданы
+    # схему создаёт `python migrations.py upgrade`, здесь только сверяем версию
     async with _pool.acquire() as conn:
-        await conn.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-          id SERIAL PRIMARY KEY,
-          telegram_id BIGINT UNIQUE NOT NULL,
-          first_name TEXT,
-          created_at TIMESTAMPTZ DEFAULT now()
-        );
-
-        CREATE TABLE IF NOT EXISTS wallets (
-          user_id INT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
-          available NUMERIC(12,2) NOT NULL DEFAULT 0,
-          reserved  NUMERIC(12,2) NOT NULL DEFAULT 0
-        );
-
-        CREATE TABLE IF NOT EXISTS tokens (
-          token_id   UUID PRIMARY KEY,
-          user_id    INT REFERENCES users(id) ON DELETE CASCADE,
-          amount     NUMERIC(12,2) NOT NULL,
-          created_at TIMESTAMPTZ DEFAULT now(),
-          redeemed_at TIMESTAMPTZ
-        );
-
-        CREATE TABLE IF NOT EXISTS transfers (
-          id         SERIAL PRIMARY KEY,
-          from_user  INT REFERENCES users(id) ON DELETE CASCADE,
-          to_user    INT REFERENCES users(id) ON DELETE CASCADE,
-          amount     NUMERIC(12,2) NOT NULL,
-          created_at TIMESTAMPTZ DEFAULT now()
-        );
-        """)
+        version = await current_version(conn)
+        if version < LATEST_VERSION:
+            if not DB_AUTO_MIGRATE:
+                raise RuntimeError(
+                    f"Схема БД v{version}, требуется v{LATEST_VERSION}: "
+                    "запустите `python migrations.py upgrade`"
+                )
+            await migrate(conn)
+
+async def warm_up(queries: list[tuple[str, list]]):
+    """
+    Прогрев перед готовностью: все DB_POOL_MIN соединений выполняют горячие
+    запросы только на чтение, чтобы подготовленные операторы уже лежали
+    в кэше каждого соединения.
+    """
+    async def prime():
+        async with _pool.acquire() as conn:
+            for sql, args in queries:
+                await conn.fetch(sql, *args)
+
+    await asyncio.gather(*(prime() for _ in range(DB_POOL_MIN)))
+
+
+async def check_db(timeout: float = 1.0) -> bool:
+    """
+    Пул жив: за timeout удалось взять соединение и выполнить SELECT 1.
+    """
+    if _pool is None:
+        return False
+    try:
+        async with _pool.acquire(timeout=timeout) as conn:
+            await conn.fetchval("SELECT 1", timeout=timeout)
+    except (asyncio.TimeoutError, OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+        return False
+    return True
+
 
 async def close_db():
     """
@@ -66,7 +186,7 @@ async def close_db():
         await _pool.close()
         _pool = None
 
-def get_pool() -> asyncpg.Pool:
+def get_pool() -> InstrumentedPool:
     """
     Возвращает готовый пул соединений.
     Вызывать можно из любых роутеров через Depends или напрямую.
@@ -74,3 +194,21 @@ def get_pool() -> asyncpg.Pool:
     if _pool is None:
         raise RuntimeError("DB не инициализирована. Проверьте, что init_db был вызван на старте.")
     return _pool
+
+
+def pool_stats() -> dict:
+    """
+    Снимок состояния пула для подбора DB_POOL_MAX.
+    """
+    stats = {
+        "size": 0, "idle": 0, "in_use": 0,
+        "min_size": DB_POOL_MIN, "max_size": DB_POOL_MAX,
+        "acquire_wait": pool_metrics.acquire_wait.snapshot(),
+        "query_errors": pool_metrics.query_errors,
+        "queries": {q: h.snapshot() for q, h in pool_metrics.queries.items()},
+    }
+    if _pool is not None:
+        stats["size"] = _pool.get_size()
+        stats["idle"] = _pool.get_idle_size()
+        stats["in_use"] = stats["size"] - stats["idle"]
+    return stats
@@ -1,47 +1,86 @@
 # gateway/deps.py
 
+import hmac
 import os
-from fastapi import Depends, HTTPException
+from fastapi import Depends, HTTPException, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from jose import jwt, JWTError
+from cache import TTLCache
 from db import get_pool
+import jwt_service
 
-# Читаем секрет из окружения
-JWT_SECRET = os.getenv("JWT_SECRET")  
-if not JWT_SECRET:
-    raise RuntimeError("JWT_SECRET не задана в окружении")
-
-ALGORITHM = "HS256"
 bearer = HTTPBearer()
 
+# telegram_id → users.id: после первого upsert'а запросы идут без БД
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "100000"))
+IDENTITY_CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", "600"))
+identity_cache = TTLCache(maxsize=IDENTITY_CACHE_SIZE, ttl=IDENTITY_CACHE_TTL)
+
+# служебные /metrics и /stats: с этим токеном (Authorization: Bearer ...);
+# без него — только с локального адреса
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+LOCAL_HOSTS = {"127.0.0.1", "::1"}
+
+
+async def upsert_user(conn, telegram_id: int, first: str) -> int:
+    """
+    Создаёт (или обновляет имя) пользователя и гарантирует запись в wallets.
+    Возвращает users.id.
+    """
+    rec = await conn.fetchrow(
+        """
+        INSERT INTO users (telegram_id, first_name)
+        VALUES ($1, $2)
+        ON CONFLICT (telegram_id) DO UPDATE
+          SET first_name = EXCLUDED.first_name
+        RETURNING id
+        """,
+        telegram_id, first
+    )
+    uid = rec["id"]
+    # Гарантируем, что у пользователя есть запись в wallets
+    await conn.execute(
+        "INSERT INTO wallets (user_id) VALUES ($1) ON CONFLICT DO NOTHING",
+        uid
+    )
+    identity_cache.set(telegram_id, uid)
+    return uid
+
+
 async def current_user(
     creds: HTTPAuthorizationCredentials = Depends(bearer)
 ):
     token = creds.credentials
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
-    except JWTError:
+        payload = jwt_service.decode(token)
+    except jwt_service.TokenError:
         raise HTTPException(401, "Invalid token")
 
+    # Токены от /auth/telegram несут подписанный uid: пользователь и кошелёк
+    # уже созданы при выдаче токена, в БД идти не нужно
+    uid = payload.get("uid")
+    if uid is not None:
+        return {"user_id": int(uid)}
+
     tg_id = int(payload.get("sub", 0))
-    first = payload.get("first", "")
+    uid = identity_cache.get(tg_id)
+    if uid is not None:
+        return {"user_id": uid}
 
+    first = payload.get("first", "")
     pool = get_pool()
     async with pool.acquire() as conn:
-        rec = await conn.fetchrow(
-            """
-            INSERT INTO users (telegram_id, first_name)
-            VALUES ($1, $2)
-            ON CONFLICT (telegram_id) DO UPDATE
-              SET first_name = EXCLUDED.first_name
-            RETURNING id
-            """,
-            tg_id, first
-        )
-        uid = rec["id"]
-        # Гарантируем, что у пользователя есть запись в wallets
-        await conn.execute(
-            "INSERT INTO wallets (user_id) VALUES ($1) ON CONFLICT DO NOTHING",
-            uid
-        )
+        uid = await upsert_user(conn, tg_id, first)
     return {"user_id": uid}
+
+
+async def ops_access(request: Request):
+    """
+    Доступ к служебным маршрутам: в /stats и /metrics текст SQL-запросов
+    и состояние пула, наружу их отдавать нельзя.
+    """
+    if METRICS_TOKEN:
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(token, METRICS_TOKEN):
+            raise HTTPException(401, "Invalid token")
+    elif request.client is None or request.client.host not in LOCAL_HOSTS:
+        raise HTTPException(403, "Forbidden")
@@ -0,0 +1,165 @@
+# gateway/hot_wallets.py
+"""
+Горячие кошельки: получатели, на которых одновременно сходится много
+зачислений (мерчанты).
+
+Зачисление в обычный кошелёк — UPDATE одной строки wallets, и все
+конкурентные зачисления выстраиваются в очередь за её блокировкой.
+Для горячих кошельков ledger зачисляет в одну из HOT_STRIPES строк
+wallet_stripes (выбранную случайно), а фоновый компактор периодически
+переносит накопленное в wallets. Баланс = wallets.available + сумма полос.
+Зачисление в полосу сбрасывает баланс только в кэше своего воркера;
+остальным изменённые кошельки рассылаются один раз после свёртки, так
+что там баланс горячего кошелька отстаёт не больше чем на
+HOT_COMPACT_INTERVAL.
+
+Кошелёк становится горячим, если его явно добавили в hot_wallets, или
+автоматически — когда число зачислений на него в этом воркере превысило
+HOT_CREDITS_PER_SEC.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+
+import asyncpg
+
+from db import get_pool
+import balance_cache
+
+HOT_STRIPES = int(os.getenv("HOT_STRIPES", "16"))
+HOT_CREDITS_PER_SEC = int(os.getenv("HOT_CREDITS_PER_SEC", "50"))
+HOT_COMPACT_INTERVAL = float(os.getenv("HOT_COMPACT_INTERVAL", "1"))
+# как часто перечитывать список горячих (его могли пополнить другие воркеры)
+HOT_REFRESH_INTERVAL = float(os.getenv("HOT_REFRESH_INTERVAL", "10"))
+
+log = logging.getLogger(__name__)
+
+_hot: set[int] = set()
+# user_id → (начало секундного окна, зачислений в нём)
+_credits: dict[int, tuple[float, int]] = {}
+_promoting: set[int] = set()
+_tasks: set[asyncio.Task] = set()
+_loop_task: asyncio.Task | None = None
+
+FOLD_SQL = """
+WITH folded AS (
+    DELETE FROM wallet_stripes
+     WHERE {where}
+     RETURNING user_id, amount
+), sums AS (
+    SELECT user_id, sum(amount) AS total FROM folded GROUP BY user_id
+)
+UPDATE wallets w
+   SET available = w.available + sums.total
+  FROM sums
+ WHERE w.user_id = sums.user_id
+RETURNING w.user_id
+"""
+
+
+def is_hot(uid: int) -> bool:
+    return uid in _hot
+
+
+def stripe() -> int:
+    return random.randrange(HOT_STRIPES)
+
+
+def note_credit(uid: int):
+    """
+    Учёт зачислений для автоопределения горячих кошельков.
+    """
+    if uid in _hot:
+        return
+    now = time.monotonic()
+    started, count = _credits.get(uid, (now, 0))
+    if now - started >= 1.0:
+        started, count = now, 0
+    count += 1
+    _credits[uid] = (started, count)
+    if count > HOT_CREDITS_PER_SEC and uid not in _promoting:
+        _promoting.add(uid)
+        task = asyncio.get_running_loop().create_task(_promote(uid))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+    if len(_credits) > 10_000:
+        # окна старше секунды больше не нужны
+        for key in [k for k, (t, _) in _credits.items() if now - t >= 1.0]:
+            del _credits[key]
+
+
+async def _promote(uid: int):
+    try:
+        pool = get_pool()
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "INSERT INTO hot_wallets (user_id) VALUES ($1) ON CONFLICT DO NOTHING",
+                uid
+            )
+        _hot.add(uid)
+        log.info("wallet %s promoted to hot", uid)
+    except Exception:
+        log.exception("hot wallet promotion failed for %s", uid)
+    finally:
+        _promoting.discard(uid)
+
+
+async def fold(conn: asyncpg.Connection, uid: int | None = None):
+    """
+    Переносит полосы в wallets: одного кошелька (перед списанием с него)
+    или всех сразу (компактор).
+    """
+    if uid is None:
+        rows = await conn.fetch(FOLD_SQL.format(where="true"))
+    else:
+        rows = await conn.fetch(FOLD_SQL.format(where="user_id = $1"), uid)
+    # одно уведомление на свёртку вместо уведомления на каждое зачисление
+    balance_cache.invalidate(*(r["user_id"] for r in rows))
+
+
+async def refresh():
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("SELECT user_id FROM hot_wallets")
+    _hot.clear()
+    _hot.update(r["user_id"] for r in rows)
+
+
+async def _run():
+    next_refresh = 0.0
+    while True:
+        try:
+            if time.monotonic() >= next_refresh:
+                await refresh()
+                next_refresh = time.monotonic() + HOT_REFRESH_INTERVAL
+            if _hot:
+                pool = get_pool()
+                async with pool.acquire() as conn:
+                    await fold(conn)
+        except Exception:
+            # таймаут пула, обрыв соединения — следующий круг попробует снова
+            log.exception("hot wallet compactor failed")
+        await asyncio.sleep(HOT_COMPACT_INTERVAL)
+
+
+async def start():
+    global _loop_task
+    await refresh()
+    _loop_task = asyncio.create_task(_run())
+
+
+async def stop():
+    """
+    Останавливает компактор и в последний раз сворачивает полосы.
+    """
+    global _loop_task
+    if _loop_task is not None:
+        _loop_task.cancel()
+        await asyncio.gather(_loop_task, return_exceptions=True)
+        _loop_task = None
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        await fold(conn)
@@ -0,0 +1,207 @@
+# gateway/idempotency.py
+"""
+Idempotency-Key для изменяющих запросов.
+
+Ответ на запрос с ключом сохраняется (в процессе — LRU с TTL; для
+нескольких воркеров — ещё и в таблице idempotency_keys), и повтор с тем же
+ключом получает сохранённый ответ без повторной работы с балансом. Хранится
+готовое тело ответа, и повтор отдаётся байт в байт (суммы — теми же
+цифрами, 12.30, а не 12.3).
+Ключ действует в пределах пользователя и маршрута. Ошибки (HTTPException
+и пр.) не сохраняются: повтор после ошибки выполняется заново. Сбой
+сохранения ответа уже выполненного запроса ошибкой не считается —
+сохранение повторяется, а клиент получает результат.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+from typing import Annotated, Any, Awaitable, Callable
+
+from fastapi import Header, HTTPException
+from fastapi.responses import Response
+from pydantic import BaseModel
+
+from cache import TTLCache
+from db import get_pool
+from serialization import FastJSONResponse, dumps
+
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", "postgres")
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", str(24*3600)))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "50000"))
+# столько ждём «зависший» запрос (упавший воркер), прежде чем выполнить ключ заново
+IDEMPOTENCY_PENDING_TIMEOUT = float(os.getenv("IDEMPOTENCY_PENDING_TIMEOUT", "60"))
+# попытки сохранить ответ уже выполненного запроса
+IDEMPOTENCY_STORE_RETRIES = int(os.getenv("IDEMPOTENCY_STORE_RETRIES", "3"))
+if IDEMPOTENCY_BACKEND not in ("memory", "postgres"):
+    raise RuntimeError(f"Неизвестное IDEMPOTENCY_BACKEND: {IDEMPOTENCY_BACKEND}")
+
+# раз в столько сохранённых ответов чистим просроченные строки
+PRUNE_EVERY = 1000
+
+# (user_id, route, key) → (fingerprint, status_code, тело ответа в байтах)
+responses = TTLCache(maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL)
+_inflight: dict[tuple, asyncio.Future] = {}
+_stored = 0
+
+log = logging.getLogger(__name__)
+
+
+# параметр маршрута: idempotency_key: IdempotencyKey = None
+IdempotencyKey = Annotated[str | None, Header(alias="Idempotency-Key", max_length=128)]
+
+
+def _fingerprint(payload: BaseModel | None) -> str:
+    raw = payload.model_dump_json() if payload is not None else ""
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _replay(entry: tuple, fingerprint: str) -> FastJSONResponse:
+    stored_fp, status_code, body = entry
+    if stored_fp != fingerprint:
+        raise HTTPException(422, "Idempotency-Key уже использован с другим запросом")
+    return FastJSONResponse(body, status_code=status_code)
+
+
+async def _claim_row(cache_key: tuple, fingerprint: str) -> tuple | None:
+    """
+    Занимает ключ в БД. None — ключ наш, можно выполнять;
+    иначе — сохранённый ответ (fingerprint, status_code, тело).
+    """
+    uid, route, key = cache_key
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        taken = await conn.fetchval(
+            """
+            INSERT INTO idempotency_keys (user_id, route, key, fingerprint)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (user_id, route, key) DO UPDATE
+               SET fingerprint = EXCLUDED.fingerprint,
+                   status_code = NULL, body = NULL, raw_body = NULL, created_at = now()
+             WHERE idempotency_keys.created_at < now() - make_interval(secs => $5)
+                OR (idempotency_keys.status_code IS NULL
+                    AND idempotency_keys.created_at < now() - make_interval(secs => $6))
+            RETURNING true
+            """,
+            uid, route, key, fingerprint, IDEMPOTENCY_TTL, IDEMPOTENCY_PENDING_TIMEOUT
+        )
+        if taken:
+            return None
+        row = await conn.fetchrow(
+            "SELECT fingerprint, status_code, body, raw_body FROM idempotency_keys"
+            " WHERE user_id = $1 AND route = $2 AND key = $3",
+            uid, route, key
+        )
+    if row is None or row["status_code"] is None:
+        raise HTTPException(409, "Запрос с этим Idempotency-Key ещё выполняется")
+    # строки до миграции 12 хранят ответ только в jsonb
+    body = row["raw_body"] if row["raw_body"] is not None else dumps(row["body"])
+    return row["fingerprint"], row["status_code"], body
+
+
+async def _store_row(cache_key: tuple, status_code: int, body: bytes):
+    global _stored
+    uid, route, key = cache_key
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE idempotency_keys SET status_code = $4, raw_body = $5"
+            " WHERE user_id = $1 AND route = $2 AND key = $3",
+            uid, route, key, status_code, body
+        )
+        _stored += 1
+        if _stored % PRUNE_EVERY == 0:
+            await conn.execute(
+                "DELETE FROM idempotency_keys WHERE created_at < now() - make_interval(secs => $1)",
+                IDEMPOTENCY_TTL
+            )
+
+
+async def _store_row_retrying(cache_key: tuple, status_code: int, body: bytes):
+    """
+    Сохраняет ответ выполненного запроса. Операция уже прошла, поэтому
+    ошибку не пробрасываем: клиент получит результат, а не 500 с
+    повтором, который выполнил бы её второй раз.
+    """
+    for attempt in range(IDEMPOTENCY_STORE_RETRIES):
+        try:
+            await _store_row(cache_key, status_code, body)
+            return
+        except Exception:
+            if attempt == IDEMPOTENCY_STORE_RETRIES - 1:
+                log.exception("idempotency: response for %s executed but not stored", cache_key)
+                return
+            await asyncio.sleep(0.05 * 2 ** attempt)
+
+
+async def _release_row(cache_key: tuple):
+    uid, route, key = cache_key
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "DELETE FROM idempotency_keys"
+            " WHERE user_id = $1 AND route = $2 AND key = $3 AND status_code IS NULL",
+            uid, route, key
+        )
+
+
+async def run(
+    uid: int,
+    route: str,
+    key: str | None,
+    payload: BaseModel | None,
+    handler: Callable[[], Awaitable[Any]],
+    status_code: int = 200,
+) -> Any:
+    """
+    Выполняет handler не более одного раза на (uid, route, key).
+    Без ключа — просто вызывает handler.
+    """
+    if key is None:
+        return await handler()
+
+    cache_key = (uid, route, key)
+    fingerprint = _fingerprint(payload)
+    entry = responses.get(cache_key)
+    if entry is not None:
+        return _replay(entry, fingerprint)
+
+    # одновременный повтор в этом же воркере ждёт первый запрос
+    pending = _inflight.get(cache_key)
+    if pending is not None:
+        return _replay(await asyncio.shield(pending), fingerprint)
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[cache_key] = future
+    try:
+        if IDEMPOTENCY_BACKEND == "postgres":
+            entry = await _claim_row(cache_key, fingerprint)
+            if entry is not None:
+                responses.set(cache_key, entry)
+                future.set_result(entry)
+                return _replay(entry, fingerprint)
+        try:
+            result = await handler()
+        except BaseException:
+            if IDEMPOTENCY_BACKEND == "postgres":
+                await _release_row(cache_key)
+            raise
+        # горячие маршруты /wallet возвращают уже готовый FastJSONResponse
+        body = bytes(result.body) if isinstance(result, Response) else dumps(result)
+        entry = (fingerprint, status_code, body)
+        if IDEMPOTENCY_BACKEND == "postgres":
+            await _store_row_retrying(cache_key, status_code, body)
+        responses.set(cache_key, entry)
+        future.set_result(entry)
+        if isinstance(result, Response):
+            return result
+        return FastJSONResponse(body, status_code=status_code)
+    except BaseException as e:
+        if not future.done():
+            future.set_exception(e)
+            # исключение достанется ожидающим; если их нет — не шумим в лог
+            future.exception()
+        raise
+    finally:
+        _inflight.pop(cache_key, None)
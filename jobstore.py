@@ -0,0 +1,93 @@
+# gateway/jobstore.py
+"""
+Хранилища фоновых задач SonicService.
+
+memory   — в процессе, с ограничением размера и TTL (по умолчанию);
+postgres — таблица sonic_jobs, видна всем воркерам и переживает рестарт.
+"""
+
+import os
+
+from cache import TTLCache
+from db import get_pool
+
+JOB_STORE = os.getenv("SONIC_JOB_STORE", "memory")
+JOB_TTL = float(os.getenv("SONIC_JOB_TTL", "3600"))
+JOB_STORE_SIZE = int(os.getenv("SONIC_JOB_STORE_SIZE", "10000"))
+
+
+class MemoryJobStore:
+    def __init__(self, maxsize: int = JOB_STORE_SIZE, ttl: float = JOB_TTL):
+        # job_id → { user: uid, status: str, result: dict | None }
+        self._jobs = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def create(self, job_id: str, uid: int):
+        self._jobs.set(job_id, {"user": uid, "status": "pending", "result": None})
+
+    async def update(self, job_id: str, status: str, result: dict | None = None):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job["status"] = status
+            job["result"] = result
+
+    async def get(self, job_id: str) -> dict | None:
+        return self._jobs.get(job_id)
+
+
+class PostgresJobStore:
+    # раз в столько созданий задач удаляем просроченные строки
+    PRUNE_EVERY = 500
+
+    def __init__(self, ttl: float = JOB_TTL):
+        self.ttl = ttl
+        self._created = 0
+
+    async def create(self, job_id: str, uid: int):
+        pool = get_pool()
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "INSERT INTO sonic_jobs (job_id, user_id, status) VALUES ($1, $2, 'pending')",
+                job_id, uid
+            )
+            self._created += 1
+            if self._created % self.PRUNE_EVERY == 0:
+                await conn.execute(
+                    "DELETE FROM sonic_jobs WHERE created_at < now() - make_interval(secs => $1)",
+                    self.ttl
+                )
+
+    async def update(self, job_id: str, status: str, result: dict | None = None):
+        pool = get_pool()
+        async with pool.acquire() as conn:
+            await conn.execute(
+                """
+                UPDATE sonic_jobs
+                   SET status = $2, result = $3::jsonb, updated_at = now()
+                 WHERE job_id = $1
+                """,
+                job_id, status, result
+            )
+
+    async def get(self, job_id: str) -> dict | None:
+        pool = get_pool()
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(
+                """
+                SELECT user_id, status, result
+                  FROM sonic_jobs
+                 WHERE job_id = $1
+                   AND created_at > now() - make_interval(secs => $2)
+                """,
+                job_id, self.ttl
+            )
+        if row is None:
+            return None
+        return {"user": row["user_id"], "status": row["status"], "result": row["result"]}
+
+
+def make_job_store():
+    if JOB_STORE == "memory":
+        return MemoryJobStore()
+    if JOB_STORE == "postgres":
+        return PostgresJobStore()
+    raise RuntimeError(f"Неизвестное SONIC_JOB_STORE: {JOB_STORE}")
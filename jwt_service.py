@@ -0,0 +1,129 @@
+# gateway/jwt_service.py
+"""
+Выпуск и проверка JWT (HS256) для auth.py и deps.py.
+
+Ключи разбираются один раз при импорте, HMAC-состояние ключа
+предвычислено и только копируется на каждую подпись. Недавно проверенные
+токены кэшируются до их exp, так что повторная проверка — поиск в словаре.
+
+Ротация ключей: новые токены подписываются JWT_SECRET с заголовком
+kid = JWT_KID; старые ключи перечисляются в JWT_PREVIOUS_KEYS как
+"kid1:secret1,kid2:secret2" и принимаются до истечения выданных ими токенов.
+Токены без kid проверяются текущим JWT_SECRET.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+from cache import TTLCache
+
+JWT_SECRET = os.getenv("JWT_SECRET")
+if not JWT_SECRET:
+    raise RuntimeError("JWT_SECRET не задана в окружении")
+JWT_KID = os.getenv("JWT_KID") or None
+JWT_PREVIOUS_KEYS = os.getenv("JWT_PREVIOUS_KEYS", "")
+
+ALGORITHM = "HS256"
+DECODE_CACHE_SIZE = int(os.getenv("JWT_DECODE_CACHE_SIZE", "50000"))
+DECODE_CACHE_TTL = float(os.getenv("JWT_DECODE_CACHE_TTL", "300"))
+
+
+class TokenError(Exception):
+    """Токен повреждён, подпись неверна или срок истёк."""
+
+
+class HMACKey:
+    def __init__(self, secret: str):
+        self._mac = hmac.new(secret.encode(), digestmod=hashlib.sha256)
+
+    def sign(self, data: bytes) -> bytes:
+        mac = self._mac.copy()
+        mac.update(data)
+        return mac.digest()
+
+
+def _parse_previous_keys(spec: str) -> dict[str, HMACKey]:
+    keys = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        kid, sep, secret = item.partition(":")
+        if not sep or not kid or not secret:
+            raise RuntimeError("JWT_PREVIOUS_KEYS: ожидается kid:secret[,kid:secret]")
+        keys[kid] = HMACKey(secret)
+    return keys
+
+
+_current_key = HMACKey(JWT_SECRET)
+_keys: dict[str, HMACKey] = _parse_previous_keys(JWT_PREVIOUS_KEYS)
+if JWT_KID:
+    _keys[JWT_KID] = _current_key
+
+_header = {"alg": ALGORITHM, "typ": "JWT"}
+if JWT_KID:
+    _header["kid"] = JWT_KID
+
+decode_cache = TTLCache(maxsize=DECODE_CACHE_SIZE, ttl=DECODE_CACHE_TTL)
+
+
+def _b64encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _dumps(obj: dict) -> bytes:
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+_encoded_header = _b64encode(_dumps(_header))
+
+
+def encode(claims: dict) -> str:
+    signing_input = _encoded_header + b"." + _b64encode(_dumps(claims))
+    return (signing_input + b"." + _b64encode(_current_key.sign(signing_input))).decode()
+
+
+def decode(token: str) -> dict:
+    """
+    Проверяет подпись и exp/nbf, возвращает claims. Ошибки — TokenError.
+    """
+    claims = decode_cache.get(token)
+    if claims is not None:
+        return claims
+
+    try:
+        header_b64, payload_b64, signature_b64 = token.split(".")
+        header = json.loads(_b64decode(header_b64))
+        if not isinstance(header, dict):
+            raise TokenError("bad header")
+        if header.get("alg") != ALGORITHM:
+            raise TokenError("unsupported alg")
+        kid = header.get("kid")
+        key = _current_key if kid is None else _keys.get(kid)
+        if key is None:
+            raise TokenError("unknown kid")
+        expected = key.sign(f"{header_b64}.{payload_b64}".encode())
+        if not hmac.compare_digest(expected, _b64decode(signature_b64)):
+            raise TokenError("bad signature")
+        claims = json.loads(_b64decode(payload_b64))
+        if not isinstance(claims, dict):
+            raise TokenError("bad payload")
+    except (ValueError, TypeError) as e:
+        raise TokenError(f"malformed token: {e}")
+
+    now = time.time()
+    ttl = DECODE_CACHE_TTL
+    if "exp" in claims:
+        if not isinstance(claims["exp"], (int, float)) or claims["exp"] <= now:
+            raise TokenError("token expired")
+        ttl = min(ttl, claims["exp"] - now)
+    if "nbf" in claims and not (isinstance(claims["nbf"], (int, float)) and claims["nbf"] <= now):
+        raise TokenError("token not yet valid")
+
+    decode_cache.set(token, claims, ttl=ttl)
+    return claims
@@ -0,0 +1,355 @@
+# gateway/ledger.py
+"""
+Денежные операции кошельков.
+
+Каждая операция — один SQL-оператор (CTE): условное списание и зачисление
+выполняются атомарно за один сетевой round trip, без отдельной транзакции
+и без удержания соединения между запросами. История (transfers,
+ledger_events) пишется не здесь, а пачками через audit.
+Пакетные операции — одна транзакция с постоянным числом операторов,
+сколько бы токенов ни было в пачке.
+Функции принимают уже взятое из пула соединение и возвращают запись
+или None, если условие операции не выполнено. Затронутые балансы
+сразу обновляются (или сбрасываются) в balance_cache.
+"""
+
+from decimal import Decimal
+from uuid import UUID, uuid4
+
+import asyncpg
+
+import balance_cache
+import hot_wallets
+from sweeper import TOKEN_TTL
+
+# зачисление в горячий кошелёк: в одну из полос wallet_stripes (см. hot_wallets)
+STRIPE_CREDIT_SQL = """
+    INSERT INTO wallet_stripes (user_id, stripe, amount)
+    SELECT {uid}, {stripe}, {amount} FROM {source}
+    ON CONFLICT (user_id, stripe) DO UPDATE
+       SET amount = wallet_stripes.amount + EXCLUDED.amount
+"""
+
+
+def _cache_balance(uid: int, seen: int, available, reserved):
+    # у горячего кошелька RETURNING не включает полосы — только сбрасываем;
+    # seen — balance_cache.version() до оператора
+    if hot_wallets.is_hot(uid):
+        balance_cache.invalidate(uid)
+    else:
+        balance_cache.put(uid, seen, available, reserved)
+
+
+def _credited(uid: int, hot: bool, *others: int):
+    """
+    Сброс кэша после зачисления uid и изменения строк others. Зачисление
+    в полосу горячего кошелька другим воркерам разошлёт компактор.
+    """
+    if hot and uid not in others:
+        balance_cache.invalidate_local(uid)
+        balance_cache.invalidate(*others)
+    else:
+        balance_cache.invalidate(uid, *others)
+
+
+async def topup(conn: asyncpg.Connection, uid: int, amount) -> asyncpg.Record | None:
+    seen = balance_cache.version()
+    rec = await conn.fetchrow(
+        """
+        UPDATE wallets
+           SET available = available + $2
+         WHERE user_id = $1
+         RETURNING available + coalesce(
+                       (SELECT sum(amount) FROM wallet_stripes WHERE user_id = $1), 0
+                   ) AS available,
+                   reserved
+        """,
+        uid, amount
+    )
+    if rec is not None:
+        _cache_balance(uid, seen, rec["available"], rec["reserved"])
+    return rec
+
+
+async def reserve(conn: asyncpg.Connection, uid: int, token_id: str, amount) -> asyncpg.Record | None:
+    """
+    Переводит amount из available в reserved и выпускает токен.
+    None — недостаточно свободных средств.
+    """
+    seen = balance_cache.version()
+    row = await _reserve(conn, uid, token_id, amount)
+    if row is None and hot_wallets.is_hot(uid):
+        # средства могли ещё лежать в полосах
+        await hot_wallets.fold(conn, uid)
+        row = await _reserve(conn, uid, token_id, amount)
+    if row is not None:
+        _cache_balance(uid, seen, row["available"], row["reserved"])
+    return row
+
+
+async def _reserve(conn: asyncpg.Connection, uid: int, token_id: str, amount) -> asyncpg.Record | None:
+    return await conn.fetchrow(
+        """
+        WITH debit AS (
+            UPDATE wallets
+               SET available = available - $3,
+                   reserved  = reserved + $3
+             WHERE user_id = $1
+               AND available >= $3
+             RETURNING user_id, available, reserved
+        ), token AS (
+            INSERT INTO tokens (token_id, user_id, amount)
+            SELECT $2, user_id, $3 FROM debit
+            RETURNING token_id, amount, created_at, redeemed_at
+        )
+        SELECT token.*, debit.available, debit.reserved FROM token, debit
+        """,
+        uid, token_id, amount
+    )
+
+
+async def claim(conn: asyncpg.Connection, token_id: str, uid: int) -> asyncpg.Record | None:
+    """
+    Гасит токен: снимает сумму с reserved владельца и зачисляет
+    в available предъявителя. None — токен не найден, уже погашен
+    или старше TOKEN_TTL (его резерв вернёт sweeper).
+
+    Владелец и предъявитель могут совпадать, поэтому обе стороны
+    обновляются одним UPDATE (одна строка не может меняться дважды
+    в пределах одного оператора); перед ним обе строки блокируются
+    по возрастанию user_id, как в transfer. Горячему предъявителю
+    зачисление идёт в полосу, и тогда UPDATE wallets касается только
+    владельца.
+    """
+    hot = hot_wallets.is_hot(uid)
+    if hot:
+        row = await conn.fetchrow(
+            """
+            WITH tok AS (
+                UPDATE tokens
+                   SET redeemed_at = now()
+                 WHERE token_id = $1
+                   AND redeemed_at IS NULL
+                   AND created_at > now() - make_interval(secs => $4)
+                 RETURNING user_id, amount
+            ), owner AS (
+                UPDATE wallets w
+                   SET reserved = w.reserved - tok.amount
+                  FROM tok
+                 WHERE w.user_id = tok.user_id
+            ), credit AS (
+            """ + STRIPE_CREDIT_SQL.format(uid="$2", stripe="$3", amount="amount", source="tok") + """
+            )
+            SELECT user_id, amount FROM tok
+            """,
+            token_id, uid, hot_wallets.stripe(), TOKEN_TTL
+        )
+    else:
+        row = await conn.fetchrow(
+            """
+            WITH tok AS (
+                UPDATE tokens
+                   SET redeemed_at = now()
+                 WHERE token_id = $1
+                   AND redeemed_at IS NULL
+                   AND created_at > now() - make_interval(secs => $3)
+                 RETURNING user_id, amount
+            ), locked AS (
+                SELECT w.user_id FROM wallets w, tok
+                 WHERE w.user_id IN (tok.user_id, $2)
+                 ORDER BY w.user_id
+                   FOR UPDATE OF w
+            ), moved AS (
+                UPDATE wallets w
+                   SET reserved  = w.reserved
+                                 - CASE WHEN w.user_id = tok.user_id THEN tok.amount ELSE 0 END,
+                       available = w.available
+                                 + CASE WHEN w.user_id = $2 THEN tok.amount ELSE 0 END
+                  FROM tok
+                 WHERE w.user_id IN (tok.user_id, $2)
+                   AND (SELECT count(*) FROM locked) > 0
+            )
+            SELECT user_id, amount FROM tok
+            """,
+            token_id, uid, TOKEN_TTL
+        )
+    if row is not None:
+        hot_wallets.note_credit(uid)
+        _credited(uid, hot, row["user_id"])
+    return row
+
+
+async def transfer(conn: asyncpg.Connection, from_id: int, to_id: int, amount) -> asyncpg.Record | None:
+    """
+    P2P-перевод. Списание условное: у отправителя
+    должно хватать средств, а кошелёк получателя должен существовать,
+    иначе ничего не меняется и возвращается None.
+
+    Оба кошелька блокируются заранее и всегда по возрастанию user_id,
+    поэтому встречные переводы A→B и B→A не взаимоблокируются.
+    """
+    hot = hot_wallets.is_hot(to_id)
+    row = await _transfer(conn, from_id, to_id, amount, hot)
+    if row is None and hot_wallets.is_hot(from_id):
+        await hot_wallets.fold(conn, from_id)
+        row = await _transfer(conn, from_id, to_id, amount, hot)
+    if row is not None:
+        hot_wallets.note_credit(to_id)
+        _credited(to_id, hot, from_id)
+    return row
+
+
+async def _transfer(
+    conn: asyncpg.Connection, from_id: int, to_id: int, amount, hot: bool
+) -> asyncpg.Record | None:
+    if hot:
+        # строку горячего получателя не трогаем: зачисление идёт в полосу
+        locked = "user_id = $1"
+        credit = STRIPE_CREDIT_SQL.format(uid="$2", stripe="$4", amount="$3", source="debit")
+        args = (from_id, to_id, amount, hot_wallets.stripe())
+    else:
+        locked = "user_id IN ($1, $2)"
+        credit = """
+            UPDATE wallets
+               SET available = available + $3
+             WHERE user_id = $2
+               AND EXISTS (SELECT 1 FROM debit)
+        """
+        args = (from_id, to_id, amount)
+    return await conn.fetchrow(
+        """
+        WITH locked AS (
+            SELECT user_id FROM wallets
+             WHERE """ + locked + """
+             ORDER BY user_id
+               FOR UPDATE
+        ), debit AS (
+            UPDATE wallets
+               SET available = available - $3
+             WHERE user_id = $1
+               AND available >= $3
+               AND EXISTS (SELECT 1 FROM wallets WHERE user_id = $2)
+               AND (SELECT count(*) FROM locked) > 0
+             RETURNING available
+        ), credit AS (
+        """ + credit + """
+        )
+        SELECT available + coalesce(
+                   (SELECT sum(amount) FROM wallet_stripes WHERE user_id = $1), 0
+               ) AS available
+          FROM debit
+        """,
+        *args
+    )
+
+
+async def reserve_batch(
+    conn: asyncpg.Connection, uid: int, amounts: list[Decimal]
+) -> dict[int, asyncpg.Record] | None:
+    """
+    Резервирует сразу несколько токенов в одной транзакции: суммы берутся
+    по порядку, пока хватает available. Возвращает {индекс суммы → запись
+    токена} для выпущенных; None — кошелёк не найден.
+    """
+    seen = balance_cache.version()
+    async with conn.transaction():
+        if hot_wallets.is_hot(uid):
+            await hot_wallets.fold(conn, uid)
+        available = await conn.fetchval(
+            "SELECT available FROM wallets WHERE user_id = $1 FOR UPDATE",
+            uid
+        )
+        if available is None:
+            return None
+        issued: dict[UUID, int] = {}
+        token_amounts: list[Decimal] = []
+        total = Decimal(0)
+        for i, amount in enumerate(amounts):
+            if amount > 0 and total + amount <= available:
+                issued[uuid4()] = i
+                token_amounts.append(amount)
+                total += amount
+        if not issued:
+            return {}
+        balance = await conn.fetchrow(
+            """
+            UPDATE wallets
+               SET available = available - $2,
+                   reserved  = reserved + $2
+             WHERE user_id = $1
+             RETURNING available, reserved
+            """,
+            uid, total
+        )
+        rows = await conn.fetch(
+            """
+            INSERT INTO tokens (token_id, user_id, amount)
+            SELECT t.token_id, $1, t.amount
+              FROM unnest($2::uuid[], $3::numeric[]) AS t(token_id, amount)
+            RETURNING token_id, amount, created_at, redeemed_at
+            """,
+            uid, list(issued), token_amounts
+        )
+    _cache_balance(uid, seen, balance["available"], balance["reserved"])
+    return {issued[r["token_id"]]: r for r in rows}
+
+
+async def claim_batch(
+    conn: asyncpg.Connection, token_ids: list[UUID], uid: int
+) -> list[asyncpg.Record]:
+    """
+    Гасит пачку токенов одним оператором: reserved каждого владельца
+    уменьшается на сумму его токенов, available предъявителя растёт на
+    общую сумму (горячему предъявителю — в полосу). Кошельки владельцев
+    и предъявителя блокируются заранее по возрастанию user_id, как в claim.
+    Возвращает погашенные токены (token_id, user_id, amount).
+    """
+    hot = hot_wallets.is_hot(uid)
+    rows = await conn.fetch(
+        """
+        WITH tok AS (
+            UPDATE tokens
+               SET redeemed_at = now()
+             WHERE token_id = ANY($1::uuid[])
+               AND redeemed_at IS NULL
+               AND created_at > now() - make_interval(secs => $5)
+             RETURNING token_id, user_id, amount
+        ), deltas AS (
+            SELECT user_id, sum(amount) AS reserved_delta, 0::numeric AS available_delta
+              FROM tok GROUP BY user_id
+            UNION ALL
+            -- горячему предъявителю — только полоса: его строку wallets не трогаем
+            SELECT $2, 0, coalesce(sum(amount), 0) FROM tok HAVING NOT $3
+        ), credit AS (
+            INSERT INTO wallet_stripes (user_id, stripe, amount)
+            SELECT $2, $4, sum(amount) FROM tok
+            HAVING $3 AND count(*) > 0
+            ON CONFLICT (user_id, stripe) DO UPDATE
+               SET amount = wallet_stripes.amount + EXCLUDED.amount
+        ), locked AS (
+            SELECT w.user_id FROM wallets w
+             WHERE w.user_id IN (SELECT user_id FROM deltas)
+               AND EXISTS (SELECT 1 FROM tok)
+             ORDER BY w.user_id
+               FOR UPDATE OF w
+        ), moved AS (
+            UPDATE wallets w
+               SET reserved  = w.reserved - d.reserved_delta,
+                   available = w.available + d.available_delta
+              FROM (
+                SELECT user_id,
+                       sum(reserved_delta) AS reserved_delta,
+                       sum(available_delta) AS available_delta
+                  FROM deltas GROUP BY user_id
+              ) d
+             WHERE w.user_id = d.user_id
+               AND (SELECT count(*) FROM locked) > 0
+        )
+        SELECT token_id, user_id, amount FROM tok
+        """,
+        token_ids, uid, hot, hot_wallets.stripe(), TOKEN_TTL
+    )
+    if rows:
+        hot_wallets.note_credit(uid)
+        _credited(uid, hot, *{r["user_id"] for r in rows})
+    return rows
@@ -0,0 +1,85 @@
+# gateway/lifecycle.py
+"""
+Состояние жизненного цикла процесса: готовность к трафику и счётчик
+запросов в работе для плавной остановки.
+
+Shutdown в lifespan начинается, когда uvicorn уже перестал принимать
+соединения, и снятие готовности там балансировщик не увидит. Поэтому
+SIGTERM перехватывается раньше: готовность снимается сразу, а обработчик
+uvicorn вызывается через SHUTDOWN_PRESTOP_DELAY — за это время
+балансировщик замечает 503 на /health/ready и перестаёт слать трафик.
+"""
+
+import asyncio
+import logging
+import signal
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Lifecycle:
+    def __init__(self):
+        # True — прогрев закончен, балансировщик может слать трафик
+        self.ready = False
+        self.inflight = 0
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        Ждёт завершения запросов в работе. False — не уложились в timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while self.inflight and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return not self.inflight
+
+
+lifecycle = Lifecycle()
+
+
+def install_prestop(delay: float):
+    """
+    Ставит свой обработчик SIGTERM поверх обработчика uvicorn. Вызывать
+    из lifespan: к этому моменту uvicorn свои обработчики уже поставил.
+    Повторный SIGTERM во время ожидания останавливает сервер сразу.
+    """
+    previous = signal.getsignal(signal.SIGTERM)
+    if delay <= 0 or not callable(previous):
+        return
+    loop = asyncio.get_running_loop()
+    pending = False
+
+    def handle(signum, frame):
+        nonlocal pending
+        if pending:
+            previous(signum, frame)
+            return
+        pending = True
+        lifecycle.ready = False
+        log.info("SIGTERM: not ready, stopping in %.1fs", delay)
+        # из обработчика сигнала — только потокобезопасно: будим event loop
+        loop.call_soon_threadsafe(loop.call_later, delay, previous, signum, frame)
+
+    try:
+        signal.signal(signal.SIGTERM, handle)
+    except ValueError:
+        # не главный поток (тестовый клиент) — остаётся обработчик uvicorn
+        pass
+
+
+class InflightMiddleware:
+    """
+    ASGI-middleware: считает HTTP-запросы в работе.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        lifecycle.inflight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            lifecycle.inflight -= 1
@@ -1,32 +1,192 @@
-from fastapi import FastAPI
+import logging
+import os
+from contextlib import asynccontextmanager
+
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 
-from db import init_db, close_db
-from auth import router as auth_router
-from wallet import router as wallet_router
+from db import DB_URL, init_db, close_db, pool_stats, pool_metrics, warm_up, check_db
+from deps import identity_cache, ops_access
+from lifecycle import lifecycle, install_prestop, InflightMiddleware
+from metrics import registry, MetricsMiddleware
+from ratelimit import RateLimitMiddleware
+from audit import audit
+from bank_client import BANK_TOPUP, bank
+import balance_cache
+import hot_wallets
+import sweeper
+import jwt_service
+from auth import router as auth_router, verified_cache
+from wallet import router as wallet_router, warmup_queries
 from bank_mock import router as bank_router
-from sonic import router as sonic_router
+from sonic import router as sonic_router, sonic
+
+# сколько ждать запросы и фоновые задачи SonicService при остановке
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))
+# сколько после SIGTERM отвечать 503 на /health/ready, продолжая обслуживать
+# запросы, прежде чем uvicorn перестанет принимать соединения
+SHUTDOWN_PRESTOP_DELAY = float(os.getenv("SHUTDOWN_PRESTOP_DELAY", "5"))
+
+log = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # старт: пул, прогрев соединений, подписка на изменения балансов — и только
+    # потом /health/ready начинает отвечать 200
+    await init_db(app)
+    await warm_up(warmup_queries())
+    await balance_cache.start_listener(DB_URL)
+    await hot_wallets.start()
+    await audit.start()
+    await sweeper.start()
+    if BANK_TOPUP:
+        await bank.start()
+    lifecycle.ready = True
+    install_prestop(SHUTDOWN_PRESTOP_DELAY)
+    yield
+    # остановка: с балансировки уже сняты по SIGTERM (install_prestop),
+    # uvicorn дождался соединений; дожидаемся запросов и замеров
+    lifecycle.ready = False
+    if not await lifecycle.drain(SHUTDOWN_DRAIN_TIMEOUT):
+        log.warning("shutdown: %d requests still in flight", lifecycle.inflight)
+    await sonic.drain(SHUTDOWN_DRAIN_TIMEOUT)
+    await bank.stop()
+    await sweeper.stop()
+    # после sonic: завершённые при остановке переводы тоже попадают в журнал
+    await audit.stop(SHUTDOWN_DRAIN_TIMEOUT)
+    await hot_wallets.stop()
+    await balance_cache.stop_listener()
+    await close_db()
 
-app = FastAPI(title="ScreenFree Gateway")
+app = FastAPI(title="ScreenFree Gateway", lifespan=lifespan)
+# внутри CORS, чтобы у 429 были CORS-заголовки, но до роутинга и current_user
+app.add_middleware(RateLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_methods=["*"],
-    allow_headers=["*"], allow_credentials=False
+    allow_headers=["*"], allow_credentials=False,
+    # мини-приложение в браузере читает курсор страницы и паузу после 429
+    expose_headers=["X-Next-Cursor", "Retry-After"],
 )
-
-@app.on_event("startup")
-async def startup():
-    await init_db(app)
-
-@app.on_event("shutdown")
-async def shutdown():
-    await close_db()
+app.add_middleware(InflightMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(auth_router)    # /auth/telegram
 app.include_router(wallet_router)  # /wallet/*
 app.include_router(bank_router)    # /bank/issuance
 app.include_router(sonic_router)   # /sonic/*
 
+# ----------------------------------
+# Метрики: источники, которые считают сами модули
+# ----------------------------------
+_caches = {
+    "identity": identity_cache,
+    "auth": verified_cache,
+    "jwt_decode": jwt_service.decode_cache,
+    "balance": balance_cache.balances,
+}
+
+def _pool_connections():
+    stats = pool_stats()
+    return [(("idle",), stats["idle"]), (("in_use",), stats["in_use"])]
+
+registry.collector(
+    "gateway_http_requests_in_flight", "gauge", "HTTP requests in progress", (),
+    lambda: [((), lifecycle.inflight)],
+)
+registry.collector(
+    "gateway_db_pool_connections", "gauge", "Pool connections by state", ("state",),
+    _pool_connections,
+)
+registry.collector(
+    "gateway_db_pool_acquire_wait_seconds", "histogram", "Wait for a pool connection", (),
+    lambda: [((), pool_metrics.acquire_wait)],
+)
+registry.collector(
+    "gateway_db_query_duration_seconds", "histogram", "DB query latency by statement",
+    ("statement",), lambda: [((q,), h) for q, h in pool_metrics.queries.items()],
+)
+registry.collector(
+    "gateway_db_query_errors_total", "counter", "Failed DB queries", (),
+    lambda: [((), pool_metrics.query_errors)],
+)
+registry.collector(
+    "gateway_sonic_jobs", "gauge", "Sonic jobs in progress by status", ("status",),
+    lambda: [(("queued",), sonic.queued), (("running",), sonic.running)],
+)
+registry.collector(
+    "gateway_sonic_jobs_total", "counter", "Sonic jobs finished or rejected by status",
+    ("status",),
+    lambda: [*(((s,), n) for s, n in sonic.finished.items()), (("rejected",), sonic.rejected)],
+)
+registry.collector(
+    "gateway_audit_queue_depth", "gauge", "Ledger events waiting for a batch write", (),
+    lambda: [((), audit.queued)],
+)
+registry.collector(
+    "gateway_audit_events_total", "counter", "Ledger events by destination",
+    ("destination",),
+    lambda: [(("db",), audit.written), (("spool",), audit.spooled), (("dropped",), audit.dropped)],
+)
+registry.collector(
+    "gateway_bank_requests_total", "counter", "HTTP calls to the issuing bank by kind",
+    ("kind",),
+    lambda: [(("request",), bank.requests), (("retry",), bank.retries),
+             (("failure",), bank.failures), (("batched_item",), bank.batched)],
+)
+registry.collector(
+    "gateway_bank_breaker_open", "gauge", "1 while the bank circuit breaker is open", (),
+    lambda: [((), int(bank.breaker.state == "open"))],
+)
+registry.collector(
+    "gateway_tokens_swept_total", "counter", "Tokens moved out of the hot table by the sweeper",
+    ("action",),
+    lambda: [(("released",), sweeper.released), (("archived",), sweeper.archived)],
+)
+registry.collector(
+    "gateway_cache_hits_total", "counter", "In-process cache hits", ("cache",),
+    lambda: [((name,), c.hits) for name, c in _caches.items()],
+)
+registry.collector(
+    "gateway_cache_misses_total", "counter", "In-process cache misses", ("cache",),
+    lambda: [((name,), c.misses) for name, c in _caches.items()],
+)
+registry.collector(
+    "gateway_cache_entries", "gauge", "In-process cache size", ("cache",),
+    lambda: [((name,), len(c)) for name, c in _caches.items()],
+)
+
+@app.get("/metrics", include_in_schema=False, dependencies=[Depends(ops_access)])
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/ping")
 async def ping():
     return {"pong": True}
+
+@app.get("/health/live")
+async def health_live():
+    """Процесс жив и обслуживает event loop."""
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+async def health_ready():
+    """Готов к трафику: прогрет, не останавливается, пул отвечает."""
+    db_ok = lifecycle.ready and await check_db()
+    stats = pool_stats()
+    body = {
+        "ready": db_ok,
+        "inflight": lifecycle.inflight,
+        "sonic_pending": sonic.pending,
+        "pool": {k: stats[k] for k in ("size", "idle", "in_use", "max_size")},
+    }
+    return JSONResponse(body, status_code=200 if db_ok else 503)
+
+@app.get("/stats", include_in_schema=False, dependencies=[Depends(ops_access)])
+async def stats():
+    return {
+        "db": pool_stats(),
+        "identity_cache": identity_cache.stats(),
+        "balance_cache": balance_cache.balances.stats(),
+    }
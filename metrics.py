@@ -0,0 +1,195 @@
+# gateway/metrics.py
+
+import logging
+import os
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Iterable
+
+# границы бакетов в секундах: от 0.5 мс до 10 с
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными бакетами: observe() — O(log n) без аллокаций.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # последний счётчик — всё, что больше верхней границы (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Оценка квантиля по верхней границе бакета. Для значений выше
+        последней границы — сама эта граница: inf не кодируется в JSON.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Counter:
+    def __init__(self):
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class HistogramFamily:
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.children: dict[tuple, Histogram] = {}
+
+    def labels(self, *values: str) -> Histogram:
+        hist = self.children.get(values)
+        if hist is None:
+            hist = self.children[values] = Histogram(self.buckets)
+        return hist
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Registry:
+    """
+    Набор метрик в текстовом формате Prometheus. Источник каждого семейства —
+    функция, возвращающая пары (значения меток, число | Histogram), поэтому
+    уже существующие счётчики (кэши, пул, SonicService) подключаются без
+    копирования.
+    """
+
+    def __init__(self):
+        self._families: list[tuple[str, str, str, tuple, Callable[[], Iterable]]] = []
+
+    def collector(self, name: str, kind: str, help: str, labelnames: tuple,
+                  samples: Callable[[], Iterable[tuple[tuple, Any]]]):
+        self._families.append((name, kind, help, labelnames, samples))
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Counter:
+        counter = Counter()
+        self.collector(name, "counter", help, labelnames, lambda: counter.values.items())
+        return counter
+
+    def histogram(self, name: str, help: str, labelnames: tuple = ()) -> HistogramFamily:
+        family = HistogramFamily()
+        self.collector(name, "histogram", help, labelnames, lambda: family.children.items())
+        return family
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for name, kind, help, labelnames, samples in self._families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for values, sample in list(samples()):
+                if kind != "histogram":
+                    lines.append(f"{name}{_labels(labelnames, values)} {sample}")
+                    continue
+                bucket_names = labelnames + ("le",)
+                cumulative = 0
+                for bound, n in zip(sample.buckets, sample.counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_labels(bucket_names, values + (bound,))} {cumulative}")
+                lines.append(f"{name}_bucket{_labels(bucket_names, values + ('+Inf',))} {sample.count}")
+                lines.append(f"{name}_sum{_labels(labelnames, values)} {sample.sum}")
+                lines.append(f"{name}_count{_labels(labelnames, values)} {sample.count}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "gateway_http_requests_total", "HTTP requests by route and status",
+    ("method", "route", "status"),
+)
+http_latency = registry.histogram(
+    "gateway_http_request_duration_seconds", "HTTP request latency",
+    ("method", "route"),
+)
+
+# X-Profile: 1 включает сэмплирующий профайлер (pyinstrument) для одного запроса
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+log = logging.getLogger(__name__)
+
+
+class MetricsMiddleware:
+    """
+    ASGI-middleware: задержка, статус и путь маршрута (шаблон, а не URL)
+    для каждого HTTP-запроса.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        profiler = None
+        if PROFILING_ENABLED and (b"x-profile", b"1") in scope["headers"]:
+            if Profiler is None:
+                log.warning("X-Profile: pyinstrument не установлен")
+            else:
+                profiler = Profiler(async_mode="enabled")
+                profiler.start()
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            route = getattr(scope.get("route"), "path", "<unmatched>")
+            method = scope["method"]
+            http_latency.labels(method, route).observe(elapsed)
+            http_requests.inc((method, route, status))
+            if profiler is not None:
+                profiler.stop()
+                log.info("profile %s %s (%.1f ms)\n%s",
+                         method, route, elapsed * 1000, profiler.output_text())
@@ -0,0 +1,326 @@
+# gateway/migrations.py
+"""
+Версионированные миграции схемы.
+
+Запускаются отдельно от старта приложения (перед раскаткой новой версии):
+
+    python migrations.py upgrade   # накатить недостающие миграции
+    python migrations.py status    # текущая и последняя версии
+
+Приложение на старте лишь сверяет версию (см. db.init_db). Параллельные
+запуски сериализуются advisory lock'ом; если схема уже актуальна, runner
+не берёт блокировку и не выполняет DDL.
+Уже выпущенные миграции не редактируются — только новые в конец списка.
+
+Миграция — строка SQL (выполняется в своей транзакции) или список
+операторов: каждый выполняется отдельно, вне транзакции. Списком пишутся
+индексы на живых таблицах — CREATE INDEX CONCURRENTLY не блокирует запись,
+но в транзакции не работает.
+"""
+
+import asyncio
+import os
+import re
+import sys
+
+import asyncpg
+
+# произвольный, но постоянный ключ advisory lock для миграций
+LOCK_KEY = 7_211_004_001
+
+MIGRATIONS: list[tuple[int, str, str | list[str]]] = [
+    (1, "baseline schema", """
+        CREATE TABLE IF NOT EXISTS users (
+          id SERIAL PRIMARY KEY,
+          telegram_id BIGINT UNIQUE NOT NULL,
+          first_name TEXT,
+          created_at TIMESTAMPTZ DEFAULT now()
+        );
+
+        CREATE TABLE IF NOT EXISTS wallets (
+          user_id INT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+          available NUMERIC(12,2) NOT NULL DEFAULT 0,
+          reserved  NUMERIC(12,2) NOT NULL DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS tokens (
+          token_id   UUID PRIMARY KEY,
+          user_id    INT REFERENCES users(id) ON DELETE CASCADE,
+          amount     NUMERIC(12,2) NOT NULL,
+          created_at TIMESTAMPTZ DEFAULT now(),
+          redeemed_at TIMESTAMPTZ
+        );
+
+        CREATE TABLE IF NOT EXISTS transfers (
+          id         SERIAL PRIMARY KEY,
+          from_user  INT REFERENCES users(id) ON DELETE CASCADE,
+          to_user    INT REFERENCES users(id) ON DELETE CASCADE,
+          amount     NUMERIC(12,2) NOT NULL,
+          created_at TIMESTAMPTZ DEFAULT now()
+        );
+
+        CREATE TABLE IF NOT EXISTS sonic_jobs (
+          job_id     TEXT PRIMARY KEY,
+          user_id    INT REFERENCES users(id) ON DELETE CASCADE,
+          status     TEXT NOT NULL,
+          result     JSONB,
+          created_at TIMESTAMPTZ DEFAULT now(),
+          updated_at TIMESTAMPTZ DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS sonic_jobs_created_at_idx ON sonic_jobs (created_at);
+    """),
+    (2, "tokens and transfers indexes", [
+        # wallet.get_tokens и keyset-пагинация: ORDER BY created_at DESC, token_id DESC
+        """CREATE INDEX CONCURRENTLY IF NOT EXISTS tokens_user_keyset_idx
+            ON tokens (user_id, created_at DESC, token_id DESC)
+            INCLUDE (amount, redeemed_at)""",
+        # непогашенные резервы — малая и самая горячая часть таблицы
+        """CREATE INDEX CONCURRENTLY IF NOT EXISTS tokens_unredeemed_keyset_idx
+            ON tokens (user_id, created_at DESC, token_id DESC)
+            WHERE redeemed_at IS NULL""",
+        """CREATE INDEX CONCURRENTLY IF NOT EXISTS transfers_from_user_keyset_idx
+            ON transfers (from_user, created_at DESC, id DESC)""",
+        """CREATE INDEX CONCURRENTLY IF NOT EXISTS transfers_to_user_keyset_idx
+            ON transfers (to_user, created_at DESC, id DESC)""",
+    ]),
+    (3, "drop pre-keyset indexes", [
+        # остались только в базах, где успела пройти первая редакция миграции 2
+        "DROP INDEX CONCURRENTLY IF EXISTS tokens_user_created_idx",
+        "DROP INDEX CONCURRENTLY IF EXISTS tokens_unredeemed_idx",
+        "DROP INDEX CONCURRENTLY IF EXISTS transfers_from_user_idx",
+        "DROP INDEX CONCURRENTLY IF EXISTS transfers_to_user_idx",
+    ]),
+    (4, "idempotency keys", """
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+          user_id     INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+          route       TEXT NOT NULL,
+          key         TEXT NOT NULL,
+          fingerprint TEXT NOT NULL,
+          status_code INT,            -- NULL: запрос ещё выполняется
+          body        JSONB,
+          created_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+          PRIMARY KEY (user_id, route, key)
+        );
+        CREATE INDEX IF NOT EXISTS idempotency_keys_created_at_idx
+            ON idempotency_keys (created_at);
+    """),
+    (5, "wallet change notifications", """
+        -- новый баланс строки для balance_cache других воркеров (LISTEN wallet_changed)
+        CREATE OR REPLACE FUNCTION notify_wallet_changed() RETURNS trigger AS $$
+        BEGIN
+          PERFORM pg_notify('wallet_changed', json_build_object(
+            'user_id', NEW.user_id,
+            'available', NEW.available,
+            'reserved', NEW.reserved
+          )::text);
+          RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS wallets_notify_changed ON wallets;
+        CREATE TRIGGER wallets_notify_changed
+            AFTER INSERT OR UPDATE ON wallets
+            FOR EACH ROW EXECUTE FUNCTION notify_wallet_changed();
+    """),
+    (6, "hot wallet stripes", """
+        CREATE TABLE IF NOT EXISTS hot_wallets (
+          user_id    INT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+          created_at TIMESTAMPTZ DEFAULT now()
+        );
+
+        -- зачисления в горячие кошельки до свёртки компактором в wallets
+        CREATE TABLE IF NOT EXISTS wallet_stripes (
+          user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+          stripe  SMALLINT NOT NULL,
+          amount  NUMERIC(14,2) NOT NULL DEFAULT 0,
+          PRIMARY KEY (user_id, stripe)
+        );
+
+        -- баланс в уведомлении включает ещё не свёрнутые полосы
+        CREATE OR REPLACE FUNCTION notify_wallet_changed() RETURNS trigger AS $$
+        BEGIN
+          PERFORM pg_notify('wallet_changed', json_build_object(
+            'user_id', w.user_id,
+            'available', w.available + coalesce(
+                (SELECT sum(s.amount) FROM wallet_stripes s WHERE s.user_id = w.user_id), 0),
+            'reserved', w.reserved
+          )::text)
+          FROM wallets w
+          WHERE w.user_id = NEW.user_id;
+          RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS wallet_stripes_notify_changed ON wallet_stripes;
+        CREATE TRIGGER wallet_stripes_notify_changed
+            AFTER INSERT OR UPDATE ON wallet_stripes
+            FOR EACH ROW EXECUTE FUNCTION notify_wallet_changed();
+    """),
+    (7, "rate limit buckets", """
+        -- состояние лимитов не нужно переживать падение сервера: без WAL
+        CREATE UNLOGGED TABLE IF NOT EXISTS rate_buckets (
+          key        TEXT PRIMARY KEY,
+          tokens     DOUBLE PRECISION NOT NULL,
+          updated_at TIMESTAMPTZ NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS rate_buckets_updated_at_idx
+          ON rate_buckets (updated_at);
+    """),
+    (8, "ledger events", """
+        -- журнал денежных событий; пишется пачками через COPY (см. audit.py),
+        -- без внешних ключей, чтобы переживать удаление пользователей
+        CREATE TABLE IF NOT EXISTS ledger_events (
+          id           BIGSERIAL PRIMARY KEY,
+          kind         TEXT NOT NULL,
+          user_id      INT NOT NULL,
+          counterparty INT,
+          amount       NUMERIC(14,2) NOT NULL,
+          token_id     UUID,
+          ref          TEXT,
+          created_at   TIMESTAMPTZ NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ledger_events_user_created_idx
+          ON ledger_events (user_id, created_at);
+        CREATE INDEX IF NOT EXISTS ledger_events_created_at_idx
+          ON ledger_events (created_at);
+    """),
+    (9, "token expiry and archive", [
+        # sweeper: просроченные резервы по возрасту и давно погашенные токены
+        """CREATE INDEX CONCURRENTLY IF NOT EXISTS tokens_unredeemed_created_idx
+            ON tokens (created_at) WHERE redeemed_at IS NULL""",
+        """CREATE INDEX CONCURRENTLY IF NOT EXISTS tokens_redeemed_at_idx
+            ON tokens (redeemed_at) WHERE redeemed_at IS NOT NULL""",
+        # погашенные и просроченные токены; месячные секции создаёт sweeper.
+        # Таблица новая и пустая — обычный CREATE INDEX ничего не блокирует
+        """CREATE TABLE IF NOT EXISTS tokens_archive (
+          token_id    UUID NOT NULL,
+          user_id     INT NOT NULL,
+          amount      NUMERIC(12,2) NOT NULL,
+          created_at  TIMESTAMPTZ NOT NULL,
+          redeemed_at TIMESTAMPTZ,
+          expired_at  TIMESTAMPTZ,
+          PRIMARY KEY (token_id, created_at)
+        ) PARTITION BY RANGE (created_at)""",
+        """CREATE INDEX IF NOT EXISTS tokens_archive_user_keyset_idx
+            ON tokens_archive (user_id, created_at DESC, token_id DESC)
+            INCLUDE (amount, redeemed_at, expired_at)""",
+    ]),
+    (10, "wallet change notifications from the gateway", """
+        -- NOTIFY из триггера ставил каждый коммит ledger в очередь за общей
+        -- блокировкой; изменённые user_id рассылает balance_cache после коммита
+        DROP TRIGGER IF EXISTS wallets_notify_changed ON wallets;
+    """),
+    (11, "no notifications from hot wallet stripes", """
+        -- NOTIFY на каждое зачисление в полосу снова ставил коммиты горячих
+        -- кошельков в общую очередь; баланс рассылает компактор после свёртки
+        DROP TRIGGER IF EXISTS wallet_stripes_notify_changed ON wallet_stripes;
+        DROP FUNCTION IF EXISTS notify_wallet_changed();
+    """),
+    (12, "raw idempotent response bodies", """
+        -- ответ хранится байт в байт: jsonb переупорядочивает ключи,
+        -- а разбор в Python терял точные суммы
+        ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS raw_body BYTEA;
+    """),
+    (13, "default tokens_archive partition", """
+        -- секции sweeper создаёт по снимку кандидатов, а пачка берёт строки
+        -- с SKIP LOCKED и может захватить месяц без секции
+        CREATE TABLE IF NOT EXISTS tokens_archive_default
+            PARTITION OF tokens_archive DEFAULT;
+    """),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def current_version(conn: asyncpg.Connection) -> int:
+    """
+    Версия схемы в БД; 0 — миграции ещё не запускались.
+    """
+    exists = await conn.fetchval("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if not exists:
+        return 0
+    return await conn.fetchval("SELECT coalesce(max(version), 0) FROM schema_migrations")
+
+
+async def migrate(conn: asyncpg.Connection) -> list[int]:
+    """
+    Накатывает недостающие миграции. Возвращает список применённых версий.
+    """
+    # схема актуальна — без блокировки и без DDL
+    if await current_version(conn) >= LATEST_VERSION:
+        return []
+    applied: list[int] = []
+    await conn.execute("SELECT pg_advisory_lock($1)", LOCK_KEY)
+    try:
+        if not await conn.fetchval("SELECT to_regclass('schema_migrations') IS NOT NULL"):
+            await conn.execute("""
+            CREATE TABLE schema_migrations (
+              version    INT PRIMARY KEY,
+              name       TEXT NOT NULL,
+              applied_at TIMESTAMPTZ DEFAULT now()
+            );
+            """)
+        done = {r["version"] for r in await conn.fetch("SELECT version FROM schema_migrations")}
+        for version, name, sql in MIGRATIONS:
+            if version in done:
+                continue
+            if isinstance(sql, list):
+                await _run_outside_transaction(conn, sql)
+                await _record(conn, version, name)
+            else:
+                async with conn.transaction():
+                    await conn.execute(sql)
+                    await _record(conn, version, name)
+            applied.append(version)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", LOCK_KEY)
+    return applied
+
+
+async def _record(conn: asyncpg.Connection, version: int, name: str):
+    await conn.execute(
+        "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+        version, name
+    )
+
+
+CONCURRENT_INDEX = re.compile(r"CREATE INDEX CONCURRENTLY IF NOT EXISTS (\w+)")
+
+
+async def _run_outside_transaction(conn: asyncpg.Connection, statements: list[str]):
+    for sql in statements:
+        match = CONCURRENT_INDEX.search(sql)
+        if match:
+            # прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс,
+            # и IF NOT EXISTS его бы молча пропустил
+            invalid = await conn.fetchval(
+                "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)",
+                match.group(1)
+            )
+            if invalid:
+                await conn.execute(f"DROP INDEX CONCURRENTLY {match.group(1)}")
+        await conn.execute(sql)
+
+
+async def main(argv: list[str]) -> int:
+    command = argv[1] if len(argv) > 1 else "upgrade"
+    if command not in ("upgrade", "status"):
+        print(f"usage: {argv[0]} [upgrade|status]", file=sys.stderr)
+        return 2
+
+    dsn = os.getenv("DATABASE_URL")
+    if not dsn:
+        raise RuntimeError("DATABASE_URL не задана в окружении")
+    conn = await asyncpg.connect(dsn)
+    try:
+        if command == "upgrade":
+            applied = await migrate(conn)
+            print(f"applied: {applied or 'nothing'}")
+        print(f"schema version: {await current_version(conn)} (latest {LATEST_VERSION})")
+    finally:
+        await conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(sys.argv)))
@@ -0,0 +1,95 @@
+# gateway/pagination.py
+"""
+Keyset-пагинация по (created_at, id) и потоковая выгрузка в NDJSON.
+
+Курсор — непрозрачная для клиента строка: base64url от
+"<created_at ISO>|<id последней строки страницы>".
+
+Выгрузка держит соединение пула и транзакцию, пока клиент читает поток,
+поэтому одновременных выгрузок в воркере не больше EXPORT_CONCURRENCY:
+медленные клиенты не должны забирать соединения у остальных маршрутов.
+"""
+
+import asyncio
+import base64
+import os
+from datetime import datetime
+from typing import Any, AsyncIterator, Callable
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+from db import get_pool
+
+# сколько строк серверный курсор отдаёт за один round trip
+EXPORT_PREFETCH = 500
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "2"))
+
+_exports = asyncio.Semaphore(EXPORT_CONCURRENCY)
+
+
+def encode_cursor(created_at: datetime, key: Any) -> str:
+    raw = f"{created_at.isoformat()}|{key}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, key = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), key
+    except ValueError:
+        raise HTTPException(400, "Некорректный cursor")
+
+
+def keyset_conditions(
+    args: list,
+    key_column: str,
+    key_cast: Callable[[str], Any],
+    since: datetime | None = None,
+    until: datetime | None = None,
+    cursor: str | None = None,
+) -> list[str]:
+    """
+    Условия WHERE для диапазона дат и позиции курсора; параметры
+    дописываются в args, нумерация $n продолжается с текущей длины args.
+    Порядок выдачи — ORDER BY created_at DESC, <key_column> DESC.
+    """
+    conds: list[str] = []
+    if since is not None:
+        args.append(since)
+        conds.append(f"created_at >= ${len(args)}")
+    if until is not None:
+        args.append(until)
+        conds.append(f"created_at < ${len(args)}")
+    if cursor:
+        created_at, key = decode_cursor(cursor)
+        try:
+            key = key_cast(key)
+        except ValueError:
+            raise HTTPException(400, "Некорректный cursor")
+        args.extend((created_at, key))
+        conds.append(f"(created_at, {key_column}) < (${len(args) - 1}, ${len(args)})")
+    return conds
+
+
+def stream_ndjson(sql: str, args: list, encode: Callable[[Any], bytes]) -> StreamingResponse:
+    """
+    Отдаёт результат запроса построчно через серверный курсор asyncpg:
+    память не зависит от объёма истории. encode — запись → JSON
+    (см. serialization.RecordEncoder.one). Если все слоты выгрузок
+    заняты — 429.
+    """
+    if _exports.locked():
+        raise HTTPException(429, "Слишком много выгрузок, повторите позже",
+                            headers={"Retry-After": "5"})
+
+    async def lines() -> AsyncIterator[bytes]:
+        async with _exports:
+            pool = get_pool()
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    async for row in conn.cursor(sql, *args, prefetch=EXPORT_PREFETCH):
+                        yield encode(row) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
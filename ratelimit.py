@@ -0,0 +1,252 @@
+# gateway/ratelimit.py
+"""
+Ограничение частоты запросов: token bucket на пользователя и на IP.
+
+Проверка стоит в ASGI-middleware перед роутингом, поэтому лишний запрос
+отбрасывается с 429 до декодирования JWT и upsert'а в deps.current_user.
+Пользователь определяется по подписи bearer-токена: её нельзя подделать,
+не зная секрета, а неподписанный sub чужого токена подставить можно.
+
+IP клиента — адрес соединения. За прокси (Railway) он у всех клиентов
+один — адрес прокси, поэтому адреса прокси перечисляются в
+RATE_LIMIT_TRUSTED_PROXIES: для соединений от них клиентом считается
+крайний справа адрес X-Forwarded-For, не принадлежащий прокси. Левее
+него клиент может подставить что угодно, а соединениям не от прокси
+X-Forwarded-For не верим вовсе.
+
+memory   — корзины в процессе, у каждого uvicorn-воркера свои (фактический
+           лимит = лимит × число воркеров); полные корзины выбрасываются;
+postgres — общая UNLOGGED-таблица rate_buckets, одна UPSERT-операция на
+           проверку; при ошибке БД запрос пропускается.
+"""
+
+import ipaddress
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from fastapi.responses import JSONResponse
+
+from db import get_pool
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+
+class Limit(NamedTuple):
+    rate: float   # токенов в секунду
+    burst: float  # ёмкость корзины
+
+
+def parse_limit(raw: str) -> Limit:
+    """«rate/burst», например «0.5/10»."""
+    rate, _, burst = raw.partition("/")
+    return Limit(float(rate), float(burst or rate))
+
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_SIZE = int(os.getenv("RATE_LIMIT_SIZE", "100000"))
+# общие лимиты на все маршруты; пустое значение отключает
+RATE_LIMIT_USER = os.getenv("RATE_LIMIT_USER", "50/100")
+RATE_LIMIT_IP = os.getenv("RATE_LIMIT_IP", "100/200")
+# сети прокси перед шлюзом через запятую, например «10.0.0.0/8,100.64.0.0/10»;
+# пусто — шлюз принимает соединения напрямую, X-Forwarded-For не читается
+RATE_LIMIT_TRUSTED_PROXIES = [
+    ipaddress.ip_network(net.strip())
+    for net in os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "").split(",") if net.strip()
+]
+if RATE_LIMIT_BACKEND not in ("memory", "postgres", "off"):
+    raise RuntimeError(f"Неизвестное RATE_LIMIT_BACKEND: {RATE_LIMIT_BACKEND}")
+
+# (метод, путь) → [(user | ip, лимит)] — сверх общих лимитов;
+# дописываются из RATE_LIMIT_ROUTES: «POST /sonic/start=user:1/5,ip:5/20;…»
+ROUTE_LIMITS: dict[tuple[str, str], list[tuple[str, Limit]]] = {
+    # каждый вход — проверка подписи и запись в users
+    ("POST", "/auth/telegram"): [("ip", Limit(0.5, 10))],
+    # каждая задача — 3 с замера в SonicService
+    ("POST", "/sonic/start"): [("user", Limit(1, 5))],
+    ("POST", "/sonic/transfer"): [("user", Limit(5, 20))],
+    ("POST", "/bank/issuance"): [("ip", Limit(1, 10))],
+}
+for _item in filter(None, os.getenv("RATE_LIMIT_ROUTES", "").split(";")):
+    _route, _, _rules = _item.partition("=")
+    _method, _, _path = _route.strip().partition(" ")
+    ROUTE_LIMITS[(_method.upper(), _path.strip())] = [
+        (scope, parse_limit(raw))
+        for scope, _, raw in (r.strip().partition(":") for r in _rules.split(","))
+    ]
+
+DEFAULT_LIMITS: list[tuple[str, Limit]] = [
+    (scope, parse_limit(raw))
+    for scope, raw in (("user", RATE_LIMIT_USER), ("ip", RATE_LIMIT_IP)) if raw
+]
+
+# не ограничиваем служебные маршруты балансировщика и Prometheus
+EXEMPT_PATHS = ("/metrics", "/ping", "/health/")
+
+rate_limited = registry.counter(
+    "gateway_rate_limited_total", "Requests rejected by rate limits", ("route", "scope"),
+)
+
+
+class MemoryBuckets:
+    """
+    Корзины в процессе: key → (tokens, updated_at, full_at). Корзина,
+    которая к текущему моменту снова полная, ничем не отличается от
+    отсутствующей, поэтому такие выбрасываются с головы LRU при каждом
+    обращении; при переполнении — самые давние.
+    """
+
+    def __init__(self, maxsize: int = RATE_LIMIT_SIZE):
+        self.maxsize = maxsize
+        self._buckets: "OrderedDict[str, tuple[float, float, float]]" = OrderedDict()
+
+    async def take(self, key: str, limit: Limit) -> float:
+        """0 — токен взят; иначе через сколько секунд он появится."""
+        now = time.monotonic()
+        self._evict(now)
+        item = self._buckets.pop(key, None)
+        tokens = limit.burst
+        if item is not None:
+            tokens = min(limit.burst, item[0] + (now - item[1]) * limit.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now, now + (limit.burst - tokens) / limit.rate)
+            return (1 - tokens) / limit.rate
+        tokens -= 1
+        self._buckets[key] = (tokens, now, now + (limit.burst - tokens) / limit.rate)
+        return 0
+
+    def _evict(self, now: float):
+        buckets = self._buckets
+        while buckets:
+            key, (_, _, full_at) = next(iter(buckets.items()))
+            if full_at > now and len(buckets) < self.maxsize:
+                break
+            del buckets[key]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class PostgresBuckets:
+    """
+    Общие для воркеров корзины в rate_buckets. Пополнение и списание —
+    один UPSERT: строка меняется, только если после пополнения есть токен.
+    """
+
+    # раз в столько проверок удаляем давно не тронутые корзины
+    PRUNE_EVERY = 5000
+    # корзины старше этого заведомо полные при любых разумных лимитах
+    IDLE_TTL = 3600
+
+    TAKE_SQL = """
+        INSERT INTO rate_buckets (key, tokens, updated_at)
+        VALUES ($1, $3 - 1, clock_timestamp())
+        ON CONFLICT (key) DO UPDATE
+           SET tokens = least($3, rate_buckets.tokens + $2 * extract(
+                          epoch FROM clock_timestamp() - rate_buckets.updated_at)) - 1,
+               updated_at = clock_timestamp()
+         WHERE least($3, rate_buckets.tokens + $2 * extract(
+                 epoch FROM clock_timestamp() - rate_buckets.updated_at)) >= 1
+        RETURNING true
+    """
+
+    def __init__(self):
+        self._taken = 0
+
+    async def take(self, key: str, limit: Limit) -> float:
+        self._taken += 1
+        try:
+            async with get_pool().acquire() as conn:
+                ok = await conn.fetchval(self.TAKE_SQL, key, limit.rate, limit.burst)
+                if self._taken % self.PRUNE_EVERY == 0:
+                    await conn.execute(
+                        "DELETE FROM rate_buckets"
+                        " WHERE updated_at < now() - make_interval(secs => $1)",
+                        self.IDLE_TTL
+                    )
+        except Exception:
+            # лимиты — защита, а не точка отказа: без БД пропускаем
+            log.exception("rate limit check failed for %s", key)
+            return 0
+        # отказ значит, что токенов меньше одного: новый появится не позже 1/rate
+        return 0 if ok else 1 / limit.rate
+
+
+def make_buckets():
+    if RATE_LIMIT_BACKEND == "postgres":
+        return PostgresBuckets()
+    return MemoryBuckets()
+
+
+buckets = make_buckets()
+
+
+def _is_proxy(addr: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(addr)
+    except ValueError:
+        return False
+    return any(ip in net for net in RATE_LIMIT_TRUSTED_PROXIES)
+
+
+def _client_ip(scope) -> str:
+    client = scope.get("client")
+    peer = client[0] if client else "unknown"
+    if not RATE_LIMIT_TRUSTED_PROXIES or not _is_proxy(peer):
+        return peer
+    forwarded = b",".join(value for name, value in scope["headers"] if name == b"x-forwarded-for")
+    hops = [hop.strip() for hop in forwarded.decode("latin-1").split(",") if hop.strip()]
+    # справа налево: адреса дописывали наши прокси, первый чужой — клиент
+    for hop in reversed(hops):
+        if not _is_proxy(hop):
+            return hop
+    return hops[0] if hops else peer
+
+
+def _token_signature(scope) -> str | None:
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.partition(b" ")
+            if scheme.lower() != b"bearer" or token.count(b".") != 2:
+                return None
+            return token.rsplit(b".", 1)[1].decode("latin-1")
+    return None
+
+
+class RateLimitMiddleware:
+    """
+    ASGI-middleware: общие и маршрутные лимиты на IP и пользователя;
+    при превышении — 429 с Retry-After.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or RATE_LIMIT_BACKEND == "off"
+                or scope["path"].startswith(EXEMPT_PATHS)):
+            return await self.app(scope, receive, send)
+
+        method, path = scope["method"], scope["path"]
+        idents = {"ip": _client_ip(scope), "user": _token_signature(scope)}
+        # маршрутная корзина — на «метод путь», общая — одна на все маршруты;
+        # маршрутная первой: отказ по ней не тратит токен общей
+        checks = [(f"{method} {path}", rule) for rule in ROUTE_LIMITS.get((method, path), ())]
+        checks += [("*", rule) for rule in DEFAULT_LIMITS]
+        for name, (kind, limit) in checks:
+            ident = idents[kind]
+            if ident is None:
+                continue
+            retry_after = await buckets.take(f"{kind}|{name}|{ident}", limit)
+            if retry_after:
+                rate_limited.inc((name, kind))
+                response = JSONResponse(
+                    {"detail": "Слишком много запросов"}, status_code=429,
+                    headers={"Retry-After": str(math.ceil(retry_after))},
+                )
+                return await response(scope, receive, send)
+        await self.app(scope, receive, send)
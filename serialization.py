@@ -0,0 +1,90 @@
+# gateway/serialization.py
+"""
+Быстрая сериализация ответов горячих маршрутов.
+
+Обработчики /wallet кодируют записи asyncpg прямо в JSON (orjson) по
+заранее заданному списку полей и возвращают готовый FastJSONResponse — без
+промежуточных pydantic-моделей и без повторной валидации через
+response_model (он остаётся только для OpenAPI).
+
+Деньги (Decimal из NUMERIC) не проходят через float, а встраиваются
+готовым JSON-текстом (orjson.Fragment):
+decimal — JSON-число с точными цифрами из БД: 12.30 → 12.30 (по умолчанию);
+kopecks — целое число копеек: 12.30 → 1230.
+"""
+
+import os
+from decimal import Decimal
+from typing import Any, Iterable, Mapping
+from uuid import UUID
+
+import orjson
+from fastapi.responses import JSONResponse
+
+MONEY_ENCODING = os.getenv("MONEY_ENCODING", "decimal")
+if MONEY_ENCODING not in ("decimal", "kopecks"):
+    raise RuntimeError(f"Неизвестное MONEY_ENCODING: {MONEY_ENCODING}")
+
+_CENT = Decimal("0.01")
+# datetime в UTC — с суффиксом Z, как у pydantic
+_OPTIONS = orjson.OPT_UTC_Z
+
+
+def money(value) -> str:
+    """JSON-текст суммы."""
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    if MONEY_ENCODING == "kopecks":
+        return str(int(value.quantize(_CENT) * 100))
+    return format(value.quantize(_CENT), "f")
+
+
+def money_value(value) -> orjson.Fragment:
+    """
+    Сумма для ответов, которые собираются словарём и хранятся в JSON
+    (результаты sonic): готовый JSON-текст, без округления через float.
+    """
+    return orjson.Fragment(money(value))
+
+
+def _default(value):
+    # UUID asyncpg — подкласс uuid.UUID, orjson его сам не кодирует
+    if isinstance(value, UUID):
+        return str(value)
+    if isinstance(value, Decimal):
+        return orjson.Fragment(money(value))
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=_default, option=_OPTIONS)
+
+
+class RecordEncoder:
+    """
+    Запись → JSON-объект с выбранными полями в заданном порядке.
+    Decimal и UUID asyncpg кодирует _default, остальное — сам orjson.
+    """
+
+    def __init__(self, *names: str):
+        self.names = names
+
+    def to_dict(self, rec: Mapping) -> dict:
+        return {name: rec[name] for name in self.names}
+
+    def one(self, rec: Mapping) -> bytes:
+        return dumps(self.to_dict(rec))
+
+    def many(self, rows: Iterable[Mapping]) -> bytes:
+        return dumps([self.to_dict(r) for r in rows])
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON-ответ через orjson; bytes (от RecordEncoder) отдаются как есть.
+    """
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
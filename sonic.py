@@ -1,65 +1,258 @@
 # gateway/sonic.py
 
 import asyncio
+import logging
+import os
 import time
-from typing import Dict
+from typing import Awaitable, Callable, Dict, List
+from uuid import uuid4
 
 from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel
 
 from deps import current_user
+from idempotency import IdempotencyKey
+from jobstore import make_job_store
 from db import get_pool
+from serialization import FastJSONResponse, money_value
+from audit import audit
+import idempotency
+import ledger
 
-router = APIRouter(prefix="/sonic", tags=["sonic"])
+router = APIRouter(prefix="/sonic", tags=["sonic"], default_response_class=FastJSONResponse)
+log = logging.getLogger(__name__)
+
+# сколько замеров идёт одновременно и сколько ещё может ждать в очереди
+SONIC_WORKERS = int(os.getenv("SONIC_WORKERS", "256"))
+SONIC_QUEUE_SIZE = int(os.getenv("SONIC_QUEUE_SIZE", "2000"))
+FINAL_STATUSES = ("done", "failed")
 
 
 # ----------------------------------
 # 1) Сервис фоновых измерений
 # ----------------------------------
+class Overloaded(Exception):
+    """Очередь измерений заполнена — новую задачу не принимаем."""
+
+
+class TransferFailed(Exception):
+    """Перевод не прошёл по бизнес-причине (средства, кошелёк)."""
+
+
 class SonicService:
-    def __init__(self):
-        # job_id → { user: uid, status: str, result: dict | None }
-        self._jobs: Dict[str, Dict] = {}
+    # как часто перечитывать хранилище, если задача запущена другим воркером
+    WAIT_POLL_INTERVAL = 0.5
 
-    async def start(self, uid: int) -> str:
-        job_id = str(time.time_ns())
-        self._jobs[job_id] = {"user": uid, "status": "pending", "result": None}
-        # запускаем фоновую задачу
-        asyncio.create_task(self._run(job_id))
+    def __init__(
+        self,
+        store=None,
+        workers: int = SONIC_WORKERS,
+        queue_size: int = SONIC_QUEUE_SIZE,
+    ):
+        self._store = store or make_job_store()
+        # job_id → Event для задач этого процесса: будит ожидающих сразу по готовности
+        self._done: Dict[str, asyncio.Event] = {}
+        self._workers_count = workers
+        # принятые, но ещё не завершённые задачи (в очереди + в работе)
+        self._limit = workers + queue_size
+        self._admitted = 0
+        self._queue: asyncio.Queue | None = None
+        self._workers: List[asyncio.Task] = []
+        self._draining = False
+        # счётчики для /metrics
+        self.running = 0
+        self.rejected = 0
+        self.finished: Dict[str, int] = {status: 0 for status in FINAL_STATUSES}
+
+    def _ensure_workers(self):
+        # воркеры поднимаются лениво, уже внутри event loop приложения
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._workers = [
+                asyncio.create_task(self._worker())
+                for _ in range(self._workers_count)
+            ]
+
+    async def _submit(self, uid: int, work: Callable[[str], Awaitable[dict]]) -> str:
+        """
+        Контроль допуска: при переполнении сразу отказываем (Overloaded),
+        вместо того чтобы копить корутины и ждать соединений из пула.
+        """
+        if self._draining or self._admitted >= self._limit:
+            self.rejected += 1
+            raise Overloaded()
+        self._admitted += 1
+        try:
+            self._ensure_workers()
+            job_id = uuid4().hex
+            await self._store.create(job_id, uid)
+        except BaseException:
+            self._admitted -= 1
+            raise
+        self._done[job_id] = asyncio.Event()
+        self._queue.put_nowait((job_id, work))
         return job_id
 
-    async def _run(self, job_id: str):
-        # меняем статус, ждём 3 секунды (имитация замера)
-        self._jobs[job_id]["status"] = "running"
+    async def start(self, uid: int) -> str:
+        return await self._submit(uid, lambda job_id: self._measure())
+
+    async def transfer(self, from_id: int, to_id: int) -> str:
+        return await self._submit(
+            from_id, lambda job_id: self._transfer(job_id, from_id, to_id)
+        )
+
+    async def _worker(self):
+        while True:
+            job_id, work = await self._queue.get()
+            self.running += 1
+            try:
+                await self._run(job_id, work)
+            finally:
+                self.running -= 1
+                self._admitted -= 1
+                self._queue.task_done()
+
+    async def _run(self, job_id: str, work: Callable[[str], Awaitable[dict]]):
+        status = "failed"
+        try:
+            await self._store.update(job_id, "running")
+            try:
+                result = await work(job_id)
+            except TransferFailed as e:
+                await self._store.update(job_id, "failed", {"error": str(e)})
+            except Exception:
+                log.exception("sonic job %s failed", job_id)
+                await self._store.update(job_id, "failed", {"error": "internal error"})
+            else:
+                status = "done"
+                await self._store.update(job_id, "done", result)
+        except asyncio.CancelledError:
+            # задачу отменил drain() при остановке процесса
+            await self._store.update(job_id, "failed", {"error": "shutdown"})
+            raise
+        except Exception:
+            log.exception("sonic job %s: job store update failed", job_id)
+        finally:
+            self.finished[status] += 1
+            self._done.pop(job_id).set()
+
+    @property
+    def pending(self) -> int:
+        """Принятые и ещё не завершённые задачи."""
+        return self._admitted
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def drain(self, timeout: float):
+        """
+        Перестаёт принимать новые задачи и ждёт принятые не дольше timeout.
+        Что не успело — отменяется и помечается failed.
+        """
+        self._draining = True
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            log.warning("sonic drain: %d jobs left after %.1fs", self._admitted, timeout)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        while not self._queue.empty():
+            job_id, _ = self._queue.get_nowait()
+            try:
+                await self._store.update(job_id, "failed", {"error": "shutdown"})
+            except Exception:
+                log.exception("sonic job %s: job store update failed", job_id)
+            self._done.pop(job_id).set()
+
+    async def _measure(self) -> dict:
+        # имитация ультразвукового замера (3 секунды)
         await asyncio.sleep(3)
-        # записываем результат
-        self._jobs[job_id]["result"] = {"distance_cm": 42, "timestamp": time.time()}
-        self._jobs[job_id]["status"] = "done"
+        return {"distance_cm": 42, "timestamp": time.time()}
 
-    def status(self, job_id: str, uid: int) -> str | None:
-        job = self._jobs.get(job_id)
-        if not job or job["user"] != uid:
-            return None
-        return job["status"]
+    async def _transfer(self, job_id: str, from_id: int, to_id: int) -> dict:
+        """
+        Замер, затем списание distance_cm ₽ (1 см = 1 ₽) у отправителя и
+        зачисление получателю. Соединение из пула берётся только на время
+        самого ledger-оператора, не на время замера; запись в transfers
+        уходит в audit.
+        """
+        measurement = await self._measure()
+        distance_cm = float(measurement["distance_cm"])
+        pool = get_pool()
+        async with pool.acquire() as conn:
+            row = await ledger.transfer(conn, from_id, to_id, distance_cm)
+        if row is None:
+            raise TransferFailed("Недостаточно средств или кошелёк не найден")
+        audit.emit("transfer", from_id, distance_cm, counterparty=to_id, ref=job_id)
+        return {
+            "distance_cm": distance_cm,
+            "transferred": money_value(distance_cm),
+            "new_available": money_value(row["available"]),
+        }
 
-    def result(self, job_id: str, uid: int) -> dict | None:
-        job = self._jobs.get(job_id)
+    async def _job(self, job_id: str, uid: int) -> dict | None:
+        job = await self._store.get(job_id)
         if not job or job["user"] != uid:
             return None
-        return job["result"]
+        return job
+
+    async def status(self, job_id: str, uid: int) -> str | None:
+        job = await self._job(job_id, uid)
+        return job["status"] if job else None
+
+    async def result(self, job_id: str, uid: int) -> dict | None:
+        job = await self._job(job_id, uid)
+        return job["result"] if job else None
+
+    async def wait(self, job_id: str, uid: int, timeout: float) -> dict | None:
+        """
+        Long-poll: возвращает задачу, как только она завершится,
+        либо текущее состояние по истечении timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            job = await self._job(job_id, uid)
+            remaining = deadline - time.monotonic()
+            if job is None or job["status"] in FINAL_STATUSES or remaining <= 0:
+                return job
+            event = self._done.get(job_id)
+            try:
+                if event is not None:
+                    await asyncio.wait_for(event.wait(), remaining)
+                else:
+                    await asyncio.sleep(min(self.WAIT_POLL_INTERVAL, remaining))
+            except asyncio.TimeoutError:
+                pass
 
 
 sonic = SonicService()
 
 
+async def _start(uid: int) -> dict:
+    try:
+        job_id = await sonic.start(uid)
+    except Overloaded:
+        raise HTTPException(503, "Sonic queue is full", headers={"Retry-After": "3"})
+    return {"job_id": job_id}
+
+
 @router.post("/start")
-async def sonic_start(user=Depends(current_user)):
+async def sonic_start(
+    user=Depends(current_user),
+    idempotency_key: IdempotencyKey = None,
+):
     """
     Запускает фоновый ультразвуковой замер.
     Возвращает job_id для последующего опроса.
     """
-    job_id = await sonic.start(user["user_id"])
-    return {"job_id": job_id}
+    uid = user["user_id"]
+    return await idempotency.run(
+        uid, "sonic.start", idempotency_key, None, lambda: _start(uid)
+    )
 
 
 @router.get("/status")
@@ -68,12 +261,12 @@ async def sonic_status(
     user=Depends(current_user),
 ):
     """
-    Возвращает статус замера: pending → running → done
+    Возвращает статус замера: pending → running → done | failed
     """
-    st = sonic.status(job_id, user["user_id"])
+    st = await sonic.status(job_id, user["user_id"])
     if st is None:
         raise HTTPException(404, "Job not found")
-    return {"status": st}
+    return FastJSONResponse({"status": st})
 
 
 @router.get("/result")
@@ -84,10 +277,26 @@ async def sonic_result(
     """
     После статуса = done возвращает результат { distance_cm, timestamp }.
     """
-    res = sonic.result(job_id, user["user_id"])
+    res = await sonic.result(job_id, user["user_id"])
     if res is None:
         raise HTTPException(404, "Result not ready or not found")
-    return res
+    return FastJSONResponse(res)
+
+
+@router.get("/wait")
+async def sonic_wait(
+    job_id: str = Query(..., description="ID задачи замера"),
+    timeout: float = Query(25, ge=0, le=60, description="Сколько ждать, сек"),
+    user=Depends(current_user),
+):
+    """
+    Long-poll вместо частого опроса /status: отвечает сразу по завершении
+    замера (или по таймауту) статусом и, если готов, результатом.
+    """
+    job = await sonic.wait(job_id, user["user_id"], timeout)
+    if job is None:
+        raise HTTPException(404, "Job not found")
+    return FastJSONResponse({"status": job["status"], "result": job["result"]})
 
 
 # ----------------------------------
@@ -97,63 +306,31 @@ class TransferRequest(BaseModel):
     to_user_id: int
 
 
-@router.post("/transfer")
+async def _transfer(from_id: int, to_id: int) -> dict:
+    try:
+        transfer_id = await sonic.transfer(from_id, to_id)
+    except Overloaded:
+        raise HTTPException(503, "Sonic queue is full", headers={"Retry-After": "3"})
+    return {"transfer_id": transfer_id, "status": "pending"}
+
+
+@router.post("/transfer", status_code=202)
 async def sonic_transfer(
     req: TransferRequest,
     user=Depends(current_user),
+    idempotency_key: IdempotencyKey = None,
 ):
     """
-    Имитирует замер (3 сек) и списывает из available=distance_cm ₽,
-    переводит их пользователю to_user_id и сохраняет в таблицу transfers.
+    Принимает перевод и сразу возвращает transfer_id. Замер (3 сек),
+    списание distance_cm ₽ у отправителя и зачисление to_user_id выполняет
+    планировщик SonicService, запись в transfers — audit; итог — через
+    /sonic/wait или /sonic/result с job_id = transfer_id.
     """
     from_id = user["user_id"]
     to_id = req.to_user_id
-
-    # 1) имитируем сам ультразвуковой замер
-    await asyncio.sleep(3)
-    distance_cm = 42.0  # 1 см = 1 ₽
-
-    pool = get_pool()
-    async with pool.acquire() as conn:
-        # 2) списываем у отправителя
-        row = await conn.fetchrow(
-            """
-            UPDATE wallets
-               SET available = available - $1
-             WHERE user_id = $2
-             RETURNING available
-            """,
-            distance_cm,
-            from_id,
-        )
-        if row is None:
-            raise HTTPException(400, "Sender wallet not found")
-        new_available = float(row["available"])
-
-        # 3) зачисляем получателю
-        await conn.execute(
-            """
-            UPDATE wallets
-               SET available = available + $1
-             WHERE user_id = $2
-            """,
-            distance_cm,
-            to_id,
-        )
-
-        # 4) записываем историю переводов
-        await conn.execute(
-            """
-            INSERT INTO transfers (from_user, to_user, amount, created_at)
-            VALUES ($1, $2, $3, now())
-            """,
-            from_id,
-            to_id,
-            distance_cm,
-        )
-
-    return {
-        "distance_cm": distance_cm,
-        "transferred": distance_cm,
-        "new_available": new_available,
-    }
+    if from_id == to_id:
+        raise HTTPException(400, "Нельзя перевести самому себе")
+    return await idempotency.run(
+        from_id, "sonic.transfer", idempotency_key, req,
+        lambda: _transfer(from_id, to_id), status_code=202,
+    )
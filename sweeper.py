@@ -0,0 +1,187 @@
+# gateway/sweeper.py
+"""
+Фоновый уборщик таблицы tokens.
+
+1. Резерв живёт TOKEN_TTL: непогашенный токен старше возвращается из
+   reserved владельца в available, а сам токен уходит в архив с
+   expired_at. Кандидаты ищутся по частичному индексу
+   (created_at) WHERE redeemed_at IS NULL.
+2. Погашенные токены старше TOKEN_ARCHIVE_AFTER (от погашения)
+   переносятся в tokens_archive — таблицу, секционированную по месяцам
+   created_at. В горячей tokens остаются только живые резервы и свежие
+   погашения, поэтому её индексы малы. Секции создаются заранее по
+   кандидатам следующей пачки; строки месяца, секцию которого создать не
+   успели, ложатся в tokens_archive_default.
+
+Работа идёт пачками по SWEEP_BATCH_SIZE строк, каждая пачка — один
+оператор; за проход не больше SWEEP_MAX_BATCHES пачек каждого вида.
+Проход выполняет один воркер (advisory lock), остальные его пропускают.
+Строки, которые сейчас гасит claim, пропускаются (SKIP LOCKED).
+"""
+
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+import asyncpg
+
+from audit import audit
+from db import get_pool
+import balance_cache
+
+TOKEN_TTL = float(os.getenv("TOKEN_TTL", str(24*3600)))
+TOKEN_ARCHIVE_AFTER = float(os.getenv("TOKEN_ARCHIVE_AFTER", str(7*24*3600)))
+SWEEP_INTERVAL = float(os.getenv("SWEEP_INTERVAL", "30"))
+SWEEP_BATCH_SIZE = int(os.getenv("SWEEP_BATCH_SIZE", "500"))
+SWEEP_MAX_BATCHES = int(os.getenv("SWEEP_MAX_BATCHES", "20"))
+
+LOCK_KEY = 7_211_004_002
+
+log = logging.getLogger(__name__)
+
+# кандидаты: (условие, порядок); $1 — возраст в секундах, $2 — размер пачки
+EXPIRED = ("redeemed_at IS NULL AND created_at < now() - make_interval(secs => $1)", "created_at")
+REDEEMED = ("redeemed_at < now() - make_interval(secs => $1)", "redeemed_at")
+
+CANDIDATES_SQL = """
+    SELECT token_id FROM tokens
+     WHERE {where}
+     ORDER BY {order}
+     LIMIT $2
+       FOR UPDATE SKIP LOCKED
+"""
+
+MONTHS_SQL = """
+    SELECT DISTINCT date_trunc('month', created_at AT TIME ZONE 'UTC') AS month
+      FROM (SELECT created_at FROM tokens WHERE {where} ORDER BY {order} LIMIT $2) t
+"""
+
+RELEASE_SQL = """
+    WITH expired AS (
+        DELETE FROM tokens
+         WHERE token_id IN (""" + CANDIDATES_SQL.format(where=EXPIRED[0], order=EXPIRED[1]) + """)
+        RETURNING token_id, user_id, amount, created_at
+    ), archived AS (
+        INSERT INTO tokens_archive (token_id, user_id, amount, created_at, expired_at)
+        SELECT token_id, user_id, amount, created_at, now() FROM expired
+    ), locked AS (
+        -- по возрастанию user_id, как ledger.claim/transfer: без взаимоблокировок
+        SELECT user_id FROM wallets
+         WHERE user_id IN (SELECT user_id FROM expired)
+         ORDER BY user_id
+           FOR UPDATE
+    ), released AS (
+        UPDATE wallets w
+           SET available = w.available + e.total,
+               reserved  = w.reserved - e.total
+          FROM (SELECT user_id, sum(amount) AS total FROM expired GROUP BY user_id) e
+         WHERE w.user_id = e.user_id
+           AND (SELECT count(*) FROM locked) > 0
+    )
+    SELECT token_id, user_id, amount FROM expired
+"""
+
+ARCHIVE_SQL = """
+    WITH moved AS (
+        DELETE FROM tokens
+         WHERE token_id IN (""" + CANDIDATES_SQL.format(where=REDEEMED[0], order=REDEEMED[1]) + """)
+        RETURNING token_id, user_id, amount, created_at, redeemed_at
+    )
+    INSERT INTO tokens_archive (token_id, user_id, amount, created_at, redeemed_at)
+    SELECT token_id, user_id, amount, created_at, redeemed_at FROM moved
+"""
+
+# месяцы, для которых секция tokens_archive уже есть
+_partitions: set[datetime] = set()
+_task: asyncio.Task | None = None
+
+# счётчики для /metrics
+released = 0
+archived = 0
+
+
+async def ensure_partitions(conn: asyncpg.Connection, kind: tuple[str, str], age: float):
+    """Создаёт месячные секции архива для следующей пачки кандидатов."""
+    months = await conn.fetch(MONTHS_SQL.format(where=kind[0], order=kind[1]), age, SWEEP_BATCH_SIZE)
+    for row in months:
+        month = row["month"]
+        if month in _partitions:
+            continue
+        upper = month.replace(year=month.year + 1, month=1) if month.month == 12 \
+            else month.replace(month=month.month + 1)
+        try:
+            await conn.execute(
+                f"CREATE TABLE IF NOT EXISTS tokens_archive_{month:%Y_%m}"
+                " PARTITION OF tokens_archive"
+                f" FOR VALUES FROM ('{month:%Y-%m-%d} 00:00+00') TO ('{upper:%Y-%m-%d} 00:00+00')"
+            )
+        except (asyncpg.DuplicateTableError, asyncpg.UniqueViolationError):
+            # секцию одновременно создал другой процесс
+            pass
+        except asyncpg.CheckViolationError:
+            # строки этого месяца уже лежат в секции по умолчанию
+            log.warning("tokens_archive: %s stays in the default partition", f"{month:%Y-%m}")
+        _partitions.add(month)
+
+
+async def release_expired(conn: asyncpg.Connection) -> int:
+    """Одна пачка просроченных резервов: назад в available, токены — в архив."""
+    global released
+    await ensure_partitions(conn, EXPIRED, TOKEN_TTL)
+    rows = await conn.fetch(RELEASE_SQL, TOKEN_TTL, SWEEP_BATCH_SIZE)
+    if rows:
+        for r in rows:
+            audit.emit("release", r["user_id"], r["amount"], token_id=r["token_id"])
+        balance_cache.invalidate(*{r["user_id"] for r in rows})
+        released += len(rows)
+    return len(rows)
+
+
+async def archive_redeemed(conn: asyncpg.Connection) -> int:
+    """Одна пачка давно погашенных токенов — в архив."""
+    global archived
+    await ensure_partitions(conn, REDEEMED, TOKEN_ARCHIVE_AFTER)
+    status = await conn.execute(ARCHIVE_SQL, TOKEN_ARCHIVE_AFTER, SWEEP_BATCH_SIZE)
+    count = int(status.rsplit(" ", 1)[1])
+    archived += count
+    return count
+
+
+async def sweep() -> bool:
+    """Один проход; False — проход сейчас делает другой воркер."""
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", LOCK_KEY):
+            return False
+        try:
+            for step in (release_expired, archive_redeemed):
+                for _ in range(SWEEP_MAX_BATCHES):
+                    if await step(conn) < SWEEP_BATCH_SIZE:
+                        break
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", LOCK_KEY)
+    return True
+
+
+async def _run():
+    while True:
+        try:
+            await sweep()
+        except Exception:
+            # таймаут пула и любая другая ошибка не должны останавливать уборщик
+            log.exception("token sweep failed")
+        await asyncio.sleep(SWEEP_INTERVAL)
+
+
+async def start():
+    global _task
+    _task = asyncio.create_task(_run())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
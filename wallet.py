@@ -1,12 +1,27 @@
-from fastapi import APIRouter, Depends, HTTPException
-from pydantic import BaseModel
-from uuid import uuid4
+import logging
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from pydantic import BaseModel, Field
+from uuid import UUID, uuid4
 from datetime import datetime
+from decimal import Decimal
+from typing import Annotated, Literal
 
 from deps import current_user
 from db import get_pool
+from audit import audit
+from bank_client import BANK_TOPUP, BankRejected, BankUnavailable, bank
+import balance_cache
+import idempotency
+import ledger
+from idempotency import IdempotencyKey
+from pagination import encode_cursor, keyset_conditions, stream_ndjson
+from serialization import FastJSONResponse, RecordEncoder, dumps
+
+log = logging.getLogger(__name__)
 
-router = APIRouter(prefix="/wallet", tags=["wallet"])
+# горячие маршруты отдают FastJSONResponse сами: модели ниже — схема для OpenAPI
+router = APIRouter(prefix="/wallet", tags=["wallet"], default_response_class=FastJSONResponse)
 
 class BalanceOut(BaseModel):
     available: float
@@ -20,6 +35,8 @@ class TokenOut(BaseModel):
     amount: float
     created_at: datetime
     redeemed_at: datetime | None = None
+    # резерв истёк (TOKEN_TTL) и вернулся в available — только в истории
+    expired_at: datetime | None = None
 
 class ReserveIn(BaseModel):
     amount: float
@@ -27,110 +44,395 @@ class ReserveIn(BaseModel):
 class ClaimIn(BaseModel):
     token_id: str
 
+# ограничение размера пачки: одна транзакция не должна держать кошелёк долго
+BATCH_MAX = 1000
+
+# NaN/Infinity и суммы вне NUMERIC(12,2) не переводятся в Decimal с копейками
+BatchAmount = Annotated[float, Field(gt=0, lt=1e10, allow_inf_nan=False)]
+
+class ReserveBatchIn(BaseModel):
+    amounts: list[BatchAmount] = Field(..., min_length=1, max_length=BATCH_MAX)
+
+class ClaimBatchIn(BaseModel):
+    token_ids: list[str] = Field(..., min_length=1, max_length=BATCH_MAX)
+
+class BatchItemOut(BaseModel):
+    ok: bool
+    error: str | None = None
+
+class ReserveItemOut(BatchItemOut):
+    token: TokenOut | None = None
+
+class ClaimItemOut(BatchItemOut):
+    token_id: str
+    amount: float | None = None
+
+class ReserveBatchOut(BaseModel):
+    items: list[ReserveItemOut]
+
+class ClaimBatchOut(BaseModel):
+    items: list[ClaimItemOut]
+
+_balance_json = RecordEncoder("available", "reserved")
+_token_json = RecordEncoder("token_id", "amount", "created_at", "redeemed_at")
+_listed_token_json = RecordEncoder(
+    "token_id", "amount", "created_at", "redeemed_at", "expired_at"
+)
+_transfer_json = RecordEncoder(
+    "id", "from_user", "to_user", "amount", "created_at", "direction"
+)
+
+# у горячих кошельков часть available ещё лежит в полосах wallet_stripes
+BALANCE_SQL = """
+SELECT w.available + coalesce(
+           (SELECT sum(s.amount) FROM wallet_stripes s WHERE s.user_id = w.user_id), 0
+       ) AS available,
+       w.reserved
+  FROM wallets w
+ WHERE w.user_id = $1
+"""
+
 @router.get("/balance", response_model=BalanceOut)
 async def get_balance(user=Depends(current_user)):
-    pool = get_pool()
-    async with pool.acquire() as conn:
-        rec = await conn.fetchrow(
-            "SELECT available, reserved FROM wallets WHERE user_id = $1",
-            user["user_id"]
-        )
+    uid = user["user_id"]
+    cached = balance_cache.get(uid)
+    if cached is None:
+        seen = balance_cache.version()
+        pool = get_pool()
+        async with pool.acquire() as conn:
+            rec = await conn.fetchrow(BALANCE_SQL, uid)
+        if rec is None:
+            raise HTTPException(404, "Кошелёк не найден")
+        cached = (rec["available"], rec["reserved"])
+        balance_cache.put_if_unchanged(uid, seen, *cached)
+    available, reserved = cached
+    return FastJSONResponse(dumps({"available": available, "reserved": reserved}))
+
+async def _topup(uid: int, amt: float) -> FastJSONResponse:
+    issued = None
+    if BANK_TOPUP:
+        # ждём банк до того, как брать соединение из пула
+        try:
+            issued = await bank.issue(Decimal(str(amt)))
+        except BankUnavailable:
+            raise HTTPException(503, "Банк недоступен", headers={"Retry-After": "5"})
+        except BankRejected:
+            raise HTTPException(502, "Банк отказал в пополнении")
+    try:
+        pool = get_pool()
+        async with pool.acquire() as conn:
+            rec = await ledger.topup(conn, uid, amt)
+    except BaseException:
+        if issued is not None:
+            _unapplied_issuance(uid, amt, issued)
+        raise
     if rec is None:
+        if issued is not None:
+            _unapplied_issuance(uid, amt, issued)
         raise HTTPException(404, "Кошелёк не найден")
-    return BalanceOut(
-        available=float(rec["available"]),
-        reserved=float(rec["reserved"])
-    )
+    audit.emit("topup", uid, amt, ref=issued["token"] if issued else None)
+    return FastJSONResponse(_balance_json.one(rec))
+
+def _unapplied_issuance(uid: int, amt: float, issued: dict):
+    """
+    Банк выпустил средства, а зачисление не прошло (или неизвестно, прошло
+    ли): событие в журнал для сверки с банком, иначе выпуск потеряется.
+    """
+    log.error("bank issuance %s for user %s (%s) was not applied", issued["token"], uid, amt)
+    audit.emit("unapplied_issuance", uid, amt, ref=issued["token"])
 
 @router.post("/topup", response_model=BalanceOut)
-async def topup(payload: TopUpIn, user=Depends(current_user)):
+async def topup(
+    payload: TopUpIn,
+    user=Depends(current_user),
+    idempotency_key: IdempotencyKey = None,
+):
     amt = payload.amount
     if amt <= 0:
         raise HTTPException(400, "Сумма должна быть > 0")
-    pool = get_pool()
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE wallets SET available = available + $1 WHERE user_id = $2",
-            amt, user["user_id"]
-        )
-        rec = await conn.fetchrow(
-            "SELECT available, reserved FROM wallets WHERE user_id = $1",
-            user["user_id"]
-        )
-    return BalanceOut(
-        available=float(rec["available"]),
-        reserved=float(rec["reserved"])
+    uid = user["user_id"]
+    return await idempotency.run(
+        uid, "wallet.topup", idempotency_key, payload, lambda: _topup(uid, amt)
     )
 
+def _tokens_query(
+    uid: int,
+    unredeemed: bool,
+    since: datetime | None,
+    until: datetime | None,
+    cursor: str | None = None,
+    limit: int | None = None,
+) -> tuple[str, list]:
+    """
+    Живые токены (tokens) и архив (tokens_archive, см. sweeper) читаются
+    отдельными ветками UNION ALL, каждая по своему keyset-индексу; в архиве
+    непогашенных нет, поэтому для unredeemed он не читается.
+    """
+    args: list = [uid]
+    conds = keyset_conditions(args, "token_id", UUID, since, until, cursor)
+    page = ""
+    if limit is not None:
+        args.append(limit)
+        page = f" LIMIT ${len(args)}"
+    live = "user_id = $1 AND redeemed_at IS NULL" if unredeemed else "user_id = $1"
+    branches = [("tokens", "NULL::timestamptz", live)]
+    if not unredeemed:
+        branches.append(("tokens_archive", "expired_at", "user_id = $1"))
+    parts = [
+        f"(SELECT token_id, amount, created_at, redeemed_at, {expired} AS expired_at"
+        f" FROM {table} WHERE {' AND '.join([where] + conds)}"
+        f" ORDER BY created_at DESC, token_id DESC{page})"
+        for table, expired, where in branches
+    ]
+    sql = " UNION ALL ".join(parts) + f" ORDER BY created_at DESC, token_id DESC{page}"
+    return sql, args
+
+def warmup_queries() -> list[tuple[str, list]]:
+    """
+    Горячие запросы /wallet (на чтение) в точности в том виде, в каком их
+    шлют обработчики, — для db.warm_up.
+    """
+    return [
+        (BALANCE_SQL, [0]),
+        _tokens_query(0, False, None, None, limit=1),
+    ]
+
 @router.get("/tokens", response_model=list[TokenOut])
-async def get_tokens(user=Depends(current_user)):
+async def get_tokens(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: str | None = Query(None, description="X-Next-Cursor предыдущей страницы"),
+    unredeemed: bool = Query(False, description="Только непогашенные"),
+    since: datetime | None = None,
+    until: datetime | None = None,
+    user=Depends(current_user),
+):
+    """
+    Страница токенов, новые первыми. Если есть продолжение,
+    курсор следующей страницы приходит в заголовке X-Next-Cursor.
+    """
+    sql, args = _tokens_query(user["user_id"], unredeemed, since, until, cursor, limit + 1)
     pool = get_pool()
     async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            "SELECT token_id, amount, created_at, redeemed_at FROM tokens WHERE user_id = $1 ORDER BY created_at DESC",
-            user["user_id"]
-        )
-    return [
-        TokenOut(
-            token_id=str(r["token_id"]),
-            amount=float(r["amount"]),
-            created_at=r["created_at"],
-            redeemed_at=r["redeemed_at"],
-        )
-        for r in rows
-    ]
+        rows = await conn.fetch(sql, *args)
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        headers["X-Next-Cursor"] = encode_cursor(last["created_at"], last["token_id"])
+    return FastJSONResponse(_listed_token_json.many(rows), headers=headers)
+
+@router.get("/tokens/export")
+async def export_tokens(
+    unredeemed: bool = Query(False, description="Только непогашенные"),
+    since: datetime | None = None,
+    until: datetime | None = None,
+    user=Depends(current_user),
+):
+    """
+    Вся история токенов потоком NDJSON (по строке на токен).
+    """
+    sql, args = _tokens_query(user["user_id"], unredeemed, since, until)
+    return stream_ndjson(sql, args, _listed_token_json.one)
+
+async def _reserve(uid: int, amt: float) -> FastJSONResponse:
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        row = await ledger.reserve(conn, uid, str(uuid4()), amt)
+    if row is None:
+        raise HTTPException(400, "Недостаточно свободных средств")
+    audit.emit("reserve", uid, row["amount"], token_id=row["token_id"])
+    return FastJSONResponse(_token_json.one(row))
 
 @router.post("/reserve", response_model=TokenOut)
-async def reserve_token(payload: ReserveIn, user=Depends(current_user)):
+async def reserve_token(
+    payload: ReserveIn,
+    user=Depends(current_user),
+    idempotency_key: IdempotencyKey = None,
+):
     amt = payload.amount
+    if amt <= 0:
+        raise HTTPException(400, "Недостаточно свободных средств")
+    uid = user["user_id"]
+    return await idempotency.run(
+        uid, "wallet.reserve", idempotency_key, payload, lambda: _reserve(uid, amt)
+    )
+
+async def _claim(uid: int, token_id: str) -> dict:
     pool = get_pool()
     async with pool.acquire() as conn:
-        rec = await conn.fetchrow(
-            "SELECT available FROM wallets WHERE user_id = $1",
-            user["user_id"]
-        )
-        if not rec or amt <= 0 or amt > float(rec["available"]):
-            raise HTTPException(400, "Недостаточно свободных средств")
-        token_id = str(uuid4())
-        await conn.execute(
-            "UPDATE wallets SET available = available - $1, reserved = reserved + $1 WHERE user_id = $2",
-            amt, user["user_id"]
-        )
-        await conn.execute(
-            "INSERT INTO tokens (token_id, user_id, amount) VALUES ($1, $2, $3)",
-            token_id, user["user_id"], amt
-        )
-        row = await conn.fetchrow(
-            "SELECT token_id, amount, created_at, redeemed_at FROM tokens WHERE token_id = $1",
-            token_id
-        )
-    return TokenOut(
-        token_id=str(row["token_id"]),
-        amount=float(row["amount"]),
-        created_at=row["created_at"],
-        redeemed_at=row["redeemed_at"]
-    )
+        row = await ledger.claim(conn, token_id, uid)
+    if not row:
+        raise HTTPException(404, "Токен не найден или уже использован")
+    audit.emit("claim", row["user_id"], row["amount"], counterparty=uid, token_id=token_id)
+    return {"ok": True}
 
 @router.post("/claim")
-async def claim_token(payload: ClaimIn, user=Depends(current_user)):
+async def claim_token(
+    payload: ClaimIn,
+    user=Depends(current_user),
+    idempotency_key: IdempotencyKey = None,
+):
+    try:
+        UUID(payload.token_id)
+    except ValueError:
+        raise HTTPException(404, "Токен не найден или уже использован")
+    uid = user["user_id"]
+    return await idempotency.run(
+        uid, "wallet.claim", idempotency_key, payload, lambda: _claim(uid, payload.token_id)
+    )
+
+async def _reserve_batch(uid: int, amounts: list[float]) -> FastJSONResponse:
+    cent = Decimal("0.01")
+    decimals = [Decimal(str(a)).quantize(cent) for a in amounts]
     pool = get_pool()
     async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT * FROM tokens WHERE token_id = $1 AND redeemed_at IS NULL",
-            payload.token_id
-        )
-        if not row:
-            raise HTTPException(404, "Токен не найден или уже использован")
-        await conn.execute(
-            "UPDATE wallets SET reserved = reserved - $1 WHERE user_id = $2",
-            row["amount"], row["user_id"]
-        )
-        await conn.execute(
-            "UPDATE wallets SET available = available + $1 WHERE user_id = $2",
-            row["amount"], user["user_id"]
-        )
-        await conn.execute(
-            "UPDATE tokens SET redeemed_at = now() WHERE token_id = $1",
-            payload.token_id
-        )
-    return {"ok": True}
+        issued = await ledger.reserve_batch(conn, uid, decimals)
+    if issued is None:
+        raise HTTPException(404, "Кошелёк не найден")
+    for r in issued.values():
+        audit.emit("reserve", uid, r["amount"], token_id=r["token_id"])
+    items = []
+    for i, amount in enumerate(decimals):
+        if i in issued:
+            item = {"ok": True, "error": None, "token": _token_json.to_dict(issued[i])}
+        elif amount <= 0:
+            item = {"ok": False, "error": "Сумма должна быть > 0", "token": None}
+        else:
+            item = {"ok": False, "error": "Недостаточно свободных средств", "token": None}
+        items.append(item)
+    return FastJSONResponse(dumps({"items": items}))
+
+@router.post("/reserve/batch", response_model=ReserveBatchOut)
+async def reserve_batch(
+    payload: ReserveBatchIn,
+    user=Depends(current_user),
+    idempotency_key: IdempotencyKey = None,
+):
+    """
+    Резервирует пачку токенов за один запрос. Суммы обрабатываются по
+    порядку, пока хватает средств; результат — по каждой сумме.
+    """
+    uid = user["user_id"]
+    return await idempotency.run(
+        uid, "wallet.reserve_batch", idempotency_key, payload,
+        lambda: _reserve_batch(uid, payload.amounts),
+    )
+
+async def _claim_batch(uid: int, token_ids: list[str]) -> FastJSONResponse:
+    parsed: dict[int, UUID] = {}
+    for i, raw in enumerate(token_ids):
+        try:
+            parsed[i] = UUID(raw)
+        except ValueError:
+            pass
+    claimed = {}
+    if parsed:
+        pool = get_pool()
+        async with pool.acquire() as conn:
+            rows = await ledger.claim_batch(conn, list(set(parsed.values())), uid)
+        for r in rows:
+            audit.emit("claim", r["user_id"], r["amount"], counterparty=uid, token_id=r["token_id"])
+        claimed = {r["token_id"]: r["amount"] for r in rows}
+    items = []
+    for i, raw in enumerate(token_ids):
+        token_id = parsed.get(i)
+        # повтор одного token_id в пачке гасится один раз
+        amount = claimed.pop(token_id, None) if token_id is not None else None
+        if amount is not None:
+            item = {"ok": True, "error": None, "token_id": raw, "amount": amount}
+        else:
+            item = {"ok": False, "error": "Токен не найден или уже использован",
+                    "token_id": raw, "amount": None}
+        items.append(item)
+    return FastJSONResponse(dumps({"items": items}))
+
+@router.post("/claim/batch", response_model=ClaimBatchOut)
+async def claim_batch(
+    payload: ClaimBatchIn,
+    user=Depends(current_user),
+    idempotency_key: IdempotencyKey = None,
+):
+    """
+    Гасит пачку токенов одним оператором; результат — по каждому token_id.
+    """
+    uid = user["user_id"]
+    return await idempotency.run(
+        uid, "wallet.claim_batch", idempotency_key, payload,
+        lambda: _claim_batch(uid, payload.token_ids),
+    )
+
+class TransferOut(BaseModel):
+    id: int
+    from_user: int | None
+    to_user: int | None
+    amount: float
+    created_at: datetime
+    direction: Literal["in", "out"]
+
+def _transfers_query(
+    uid: int,
+    direction: str,
+    since: datetime | None,
+    until: datetime | None,
+    cursor: str | None = None,
+    limit: int | None = None,
+) -> tuple[str, list]:
+    """
+    Входящие и исходящие читаются отдельными ветками UNION ALL, чтобы
+    каждая шла по своему индексу (from_user|to_user, created_at DESC).
+    """
+    args: list = [uid]
+    conds = keyset_conditions(args, "id", int, since, until, cursor)
+    page = ""
+    if limit is not None:
+        args.append(limit)
+        page = f" LIMIT ${len(args)}"
+    branches = {
+        "out": "from_user = $1",
+        "in": "to_user = $1 AND from_user IS DISTINCT FROM $1",
+    }
+    parts = [
+        f"(SELECT id, from_user, to_user, amount, created_at, '{d}' AS direction"
+        f" FROM transfers WHERE {' AND '.join([where] + conds)}"
+        f" ORDER BY created_at DESC, id DESC{page})"
+        for d, where in branches.items()
+        if direction in (d, "all")
+    ]
+    sql = " UNION ALL ".join(parts) + f" ORDER BY created_at DESC, id DESC{page}"
+    return sql, args
+
+@router.get("/transfers", response_model=list[TransferOut])
+async def get_transfers(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: str | None = Query(None, description="X-Next-Cursor предыдущей страницы"),
+    direction: Literal["all", "in", "out"] = "all",
+    since: datetime | None = None,
+    until: datetime | None = None,
+    user=Depends(current_user),
+):
+    """
+    История переводов пользователя, новые первыми; пагинация как у /wallet/tokens.
+    """
+    sql, args = _transfers_query(user["user_id"], direction, since, until, cursor, limit + 1)
+    pool = get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(sql, *args)
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        headers["X-Next-Cursor"] = encode_cursor(last["created_at"], last["id"])
+    return FastJSONResponse(_transfer_json.many(rows), headers=headers)
+
+@router.get("/transfers/export")
+async def export_transfers(
+    direction: Literal["all", "in", "out"] = "all",
+    since: datetime | None = None,
+    until: datetime | None = None,
+    user=Depends(current_user),
+):
+    """
+    Вся история переводов потоком NDJSON.
+    """
+    sql, args = _transfers_query(user["user_id"], direction, since, until)
+    return stream_ndjson(sql, args, _transfer_json.one)